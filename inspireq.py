@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
 import tqdm
+import random
+import asyncio
+import ssl
 import threading
 import multiprocessing
 import re
@@ -9,14 +12,37 @@ import os
 import json
 import sys
 import urllib.request, urllib.parse, urllib.error
+import base64
+import email.utils
 import http.client
 import pickle
 import argparse
+import sqlite3
+import hashlib
+import zlib
+import gzip
+import lzma
+import contextlib
 import tempfile
+import time
 from pathlib import Path
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks (windows) - sqlite still serializes the writes
+    fcntl = None
 
 
 gDebug    = False
+gInspireURL = "https://inspirehep.net"
+gHTTPPool = None
+gRateLimiter = None
+gFetchPolicy = None
+gCacheCodec = "zlib"
+gCacheJournal = "delete"
+gCacheBundle = None
+gCacheDir = None
+gSingleFlight = None
 
 # --- generic_object.py
 
@@ -101,96 +127,1471 @@ class GenericObject(object):
         _props = [a for a in self.__dict__ if a[0] != "_"]
         return iter(_props)
 
+# --- cache_codecs.py
+
+def sqlite_uri(filename, mode=None):
+    _uri = "file:{}".format(urllib.parse.quote(os.path.abspath(filename)))
+    if mode:
+        _uri += "?mode={}".format(mode)
+    return _uri
+
+
+# --cache-dir, else .cache in the working directory
+def default_cache_dir():
+    if gCacheDir:
+        return gCacheDir
+    return os.curdir + "/.cache"
+
+
+# filesystem types where sqlite's WAL shared memory cannot be trusted across hosts
+gNetworkFilesystems = ["nfs", "nfs4", "cifs", "smbfs", "smb3", "afs", "ceph", "glusterfs", "lustre", "gpfs", "9p", "fuse.sshfs"]
+
+
+# type of the filesystem holding path from /proc/mounts - None where that is not available
+def filesystem_type(path):
+    _path = os.path.realpath(path)
+    _best = None
+    try:
+        with open("/proc/mounts", "r") as f:
+            for _line in f:
+                _fields = _line.split()
+                if len(_fields) < 3:
+                    continue
+                _mount = _fields[1].replace("\\040", " ")
+                if _path == _mount or _path.startswith(_mount.rstrip("/") + "/"):
+                    if _best is None or len(_mount) > len(_best[0]):
+                        _best = (_mount, _fields[2])
+    except OSError:
+        return None
+    if _best is None:
+        return None
+    return _best[1]
+
+
+# --cache-journal auto: wal only on a filesystem known to be local, delete everywhere else
+def cache_journal_mode(cache_dir):
+    if gCacheJournal != "auto":
+        return gCacheJournal
+    _fstype = filesystem_type(cache_dir)
+    if _fstype is None or _fstype in gNetworkFilesystems or _fstype.startswith("fuse"):
+        return "delete"
+    return "wal"
+
+
+# name -> (encode, decode) for cache blobs; entries written before compression have no codec (raw)
+gCacheCodecs = {
+    "raw": (bytes, bytes),
+    "zlib": (zlib.compress, zlib.decompress),
+    "gzip": (gzip.compress, gzip.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+def register_codec(name, encode, decode):
+    gCacheCodecs[name] = (encode, decode)
+
+
+def encode_blob(feedr, codec):
+    return gCacheCodecs[codec][0](feedr)
+
+
+def decode_blob(data, codec):
+    if codec is None:
+        return bytes(data)
+    if codec not in gCacheCodecs:
+        raise ValueError(f"cache entry written with unknown codec {codec}")
+    return gCacheCodecs[codec][1](bytes(data))
+
+
 # --- inspire_record.py
 
 class Cache(GenericObject):
-    def __init__(self, dir=None, **kwargs):
+    _shared = {}
+    _shared_lock = threading.Lock()
+    # table -> columns; columns missing from an older file are added on open
+    schema = {
+        "queries": [
+            ("url", "TEXT PRIMARY KEY"),
+            ("data", "BLOB"),
+            ("fetched", "REAL"),
+            ("hash", "TEXT"),
+            ("etag", "TEXT"),
+            ("last_modified", "TEXT"),
+            ("codec", "TEXT"),
+            ("accessed", "REAL"),
+        ],
+        "meta": [("key", "TEXT PRIMARY KEY"), ("value", "TEXT")],
+        "aliases": [("alias", "TEXT PRIMARY KEY"), ("recid", "TEXT")],
+        "citations": [("recid", "TEXT PRIMARY KEY"), ("count", "INTEGER"), ("fetched", "REAL")],
+        "snapshots": [("recid", "TEXT PRIMARY KEY"), ("url", "TEXT"), ("blob_hash", "TEXT"), ("data", "TEXT"), ("version", "INTEGER")],
+        "negatives": [("key", "TEXT PRIMARY KEY"), ("reason", "TEXT"), ("created", "REAL")],
+    }
+
+    # file= opens a single sqlite file (a bundle, see export_bundle) instead of <dir>/cache.sqlite
+    def __init__(self, dir=None, file=None, **kwargs):
         super().__init__(**kwargs)
         self.cache_dir = dir
         if self.cache_dir is None:
-            self.cache_dir = os.curdir + "/.cache"
-        self.cache_file = self.cache_dir + "/cache.db"
-        os.makedirs(self.cache_dir, exist_ok=True)
+            self.cache_dir = default_cache_dir()
+        self.cache_file = self.cache_dir + "/cache.sqlite"
+        if file is not None:
+            self.cache_file = file
+            self.cache_dir = os.path.dirname(os.path.abspath(file))
+        if not self.read_only:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        if self.codec is None:
+            self.codec = gCacheCodec
         if self.verbose:
-            print("[i] cache using", self.cache_file, file=sys.stderr)
-        if not os.path.exists(self.cache_file):
-            with open(self.cache_file, "a+") as _f:
-                if self.verbose:
-                    print("[i] cache file created", self.cache_file)
-                pass
-        if not os.path.exists(self.cache_file):
-            print("[e] cache file does not exist", self.cache_file, file=sys.stderr)
-            self.cache_file = None
-
-    def save_query(self, url_inspire, feedr):
-        with tempfile.NamedTemporaryFile(
-            mode="wb", dir=self.cache_dir, delete=False
-        ) as _ffeed:
-            with open(self.cache_file, "a+") as _fcache:
-                _fcache.writelines(
-                    ["[*url]={} [*file]={}\n".format(url_inspire, _ffeed.name)]
-                )
-            _ffeed.write(feedr)
-            _ffeed.close()
-            if self.verbose:
-                print("[i] written", _ffeed.name, file=sys.stderr)
-        self.purge(url_inspire=url_inspire)
+            print("[i] cache using", self.cache_file, "codec", self.codec, file=sys.stderr)
+        self._lock = threading.RLock()
+        self._fresh = set()
+        self._fresh_counts = set()
+        self._accessed = set()
+        # entries missing here are looked up in the bundle (--bundle)
+        self.fallback = None
+        if file is None and gCacheBundle is not None:
+            self.fallback = Cache(file=gCacheBundle, read_only=True, verbose=self.verbose)
+        if self.read_only:
+            self._db = sqlite3.connect(sqlite_uri(self.cache_file, mode="ro"), uri=True, check_same_thread=False)
+            return
+        # several report jobs may share one cache directory - writers wait for each other up to the timeout
+        # opened by URI so that import_bundle can attach other files read-only
+        self._db = sqlite3.connect(sqlite_uri(self.cache_file), uri=True, check_same_thread=False, isolation_level=None, timeout=60.0)
+        with self._lock:
+            if self.journal_mode is None and file is None:
+                self.journal_mode = cache_journal_mode(self.cache_dir)
+            if self.journal_mode:
+                self._db.execute("PRAGMA journal_mode={}".format(self.journal_mode))
+        # jobs starting together on a new or old cache file - only one creates / upgrades the schema, the others see it done
+        with self.transaction():
+            for _table, _columns in Cache.schema.items():
+                self._db.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(_table, ", ".join([" ".join(_c) for _c in _columns])))
+                self._ensure_columns(_table, dict(_columns))
+        if file is None and self.get_meta("legacy_migrated") is None:
+            with self.file_lock("migrate"):
+                # another process may have migrated while we waited
+                if self.get_meta("legacy_migrated") is None:
+                    self.migrate_legacy()
+        if self.get_meta("aliases_canonical") is None:
+            self.canonicalize_aliases()
+
+    # multi-statement updates are applied all or nothing; BEGIN IMMEDIATE takes the write lock up front
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    # advisory lock across processes for maintenance (migration, gc, import) - <cache_dir>/<name>.lock
+    @contextlib.contextmanager
+    def file_lock(self, name):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.cache_dir, name + ".lock"), "a") as _flock:
+            fcntl.flock(_flock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(_flock, fcntl.LOCK_UN)
+
+    # columns added after a cache file was first created - call inside transaction()
+    def _ensure_columns(self, table, columns):
+        _have = [_row[1] for _row in self._db.execute("PRAGMA table_info({})".format(table))]
+        for _col, _decl in columns.items():
+            if _col not in _have:
+                self._db.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, _col, _decl))
+
+    # one store per cache directory - shared by all records and threads
+    @classmethod
+    def shared(cls, dir=None, verbose=False):
+        if dir is None:
+            dir = default_cache_dir()
+        _key = os.path.abspath(dir)
+        with cls._shared_lock:
+            if _key not in cls._shared:
+                cls._shared[_key] = cls(dir=dir, verbose=verbose)
+            return cls._shared[_key]
+
+    # a new run in the same process revalidates what earlier runs fetched
+    @classmethod
+    def new_run(cls):
+        with cls._shared_lock:
+            for cache in cls._shared.values():
+                with cache._lock:
+                    cache._fresh.clear()
+                    cache._fresh_counts.clear()
+
+    def get_meta(self, key):
+        with self._lock:
+            _row = self._db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        if _row is None:
+            return None
+        return _row[0]
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    # arXiv id -> recid; keys are canonical (see canonical_arxiv_id)
+    def save_alias(self, alias, recid):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO aliases (alias, recid) VALUES (?, ?)", (canonical_arxiv_id(alias), canonical_recid(recid))
+            )
+
+    def read_alias(self, alias):
+        with self._lock:
+            _row = self._db.execute("SELECT recid FROM aliases WHERE alias=?", (canonical_arxiv_id(alias),)).fetchone()
+        if _row is None:
+            if self.fallback:
+                return self.fallback.read_alias(alias)
+            return None
+        return _row[0]
+
+    def save_citation_count(self, recid, count, fetched=None):
+        if fetched is None:
+            fetched = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO citations (recid, count, fetched) VALUES (?, ?, ?)",
+                (str(recid), int(count), fetched),
+            )
+            self._fresh_counts.add(str(recid))
+
+    def read_citation_count(self, recid):
+        with self._lock:
+            _row = self._db.execute("SELECT count FROM citations WHERE recid=?", (str(recid),)).fetchone()
+        if _row is None:
+            if self.fallback:
+                return self.fallback.read_citation_count(recid)
+            return None
+        return _row[0]
+
+    def is_fresh_count(self, recid):
+        with self._lock:
+            return str(recid) in self._fresh_counts
+
+    # True if the count was fetched more than max_age seconds ago
+    def is_stale_count(self, recid, max_age):
+        if max_age is None:
+            return False
+        with self._lock:
+            _row = self._db.execute("SELECT fetched FROM citations WHERE recid=?", (str(recid),)).fetchone()
+        if _row is None:
+            return False
+        return _row[0] is None or time.time() - _row[0] > max_age
+
+    # known failures (unresolvable arXiv ids, urls that gave 404 ...) - skipped without a request for max_age seconds
+    def save_negative(self, key, reason=None):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO negatives (key, reason, created) VALUES (?, ?, ?)", (key, reason, time.time()))
+
+    def is_negative(self, key, max_age):
+        if not max_age:
+            return False
+        with self._lock:
+            _row = self._db.execute("SELECT created FROM negatives WHERE key=?", (key,)).fetchone()
+        return _row is not None and time.time() - _row[0] <= max_age
+
+    def list_negatives(self):
+        with self._lock:
+            return self._db.execute("SELECT key, reason, created FROM negatives ORDER BY created").fetchall()
+
+    # all entries if no keys are given
+    def clear_negatives(self, keys=None):
+        with self._lock:
+            if keys:
+                return sum([self._db.execute("DELETE FROM negatives WHERE key=?", (_key,)).rowcount for _key in keys])
+            return self._db.execute("DELETE FROM negatives").rowcount
+
+    def blob_hash(self, url_inspire):
+        with self._lock:
+            _row = self._db.execute("SELECT hash FROM queries WHERE url=?", (url_inspire,)).fetchone()
+            if _row is None:
+                return None
+            if _row[0] is None:
+                # entries written before hashes were stored
+                feedr = self.read_query(url_inspire)
+                _hash = hashlib.sha1(feedr).hexdigest()
+                self._db.execute("UPDATE queries SET hash=? WHERE url=?", (_hash, url_inspire))
+                return _hash
+            return _row[0]
+
+    # fields derived from the blob at url - valid only while the blob is unchanged and they were written by the same parser version
+    def read_snapshot(self, recid, url_inspire, version):
+        with self._lock:
+            _row = self._db.execute("SELECT url, blob_hash, data, version FROM snapshots WHERE recid=?", (str(recid),)).fetchone()
+        if _row is None or _row[0] != url_inspire or _row[3] != version:
+            return None
+        if _row[1] != self.blob_hash(url_inspire):
+            return None
+        return json.loads(_row[2])
+
+    def save_snapshot(self, recid, url_inspire, fields, version):
+        _hash = self.blob_hash(url_inspire)
+        if _hash is None:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO snapshots (recid, url, blob_hash, data, version) VALUES (?, ?, ?, ?, ?)",
+                (str(recid), url_inspire, _hash, json.dumps(fields), version),
+            )
+
+    def save_query(self, url_inspire, feedr, fetched=None, etag=None, last_modified=None):
+        if fetched is None:
+            fetched = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO queries (url, data, fetched, hash, etag, last_modified, codec) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url_inspire,
+                    sqlite3.Binary(encode_blob(feedr, self.codec)),
+                    fetched,
+                    hashlib.sha1(feedr).hexdigest(),
+                    etag,
+                    last_modified,
+                    self.codec,
+                ),
+            )
+            self._fresh.add(url_inspire)
+        if self.verbose:
+            print("[i] written", url_inspire, file=sys.stderr)
+
+    # the cached copy was confirmed unchanged by the server (304 or same updated date)
+    def touch(self, url_inspire, fetched=None):
+        if fetched is None:
+            fetched = time.time()
+        with self._lock:
+            _cursor = self._db.execute("UPDATE queries SET fetched=? WHERE url=?", (fetched, url_inspire))
+            if _cursor.rowcount > 0:
+                self._fresh.add(url_inspire)
+
+    # headers for a conditional GET of the cached copy - empty if the server sent no validators
+    def validators(self, url_inspire):
+        with self._lock:
+            _row = self._db.execute("SELECT etag, last_modified FROM queries WHERE url=?", (url_inspire,)).fetchone()
+        _headers = {}
+        if _row is None:
+            return _headers
+        if _row[0]:
+            _headers["If-None-Match"] = _row[0]
+        if _row[1]:
+            _headers["If-Modified-Since"] = _row[1]
+        return _headers
+
+    # True if the cached copy was fetched more than max_age seconds ago
+    def is_stale(self, url_inspire, max_age):
+        if max_age is None:
+            return False
+        with self._lock:
+            _row = self._db.execute("SELECT fetched FROM queries WHERE url=?", (url_inspire,)).fetchone()
+        if _row is None:
+            return False
+        return _row[0] is None or time.time() - _row[0] > max_age
+
+    # True if the url was downloaded (or revalidated) during this run
+    def is_fresh(self, url_inspire):
+        with self._lock:
+            return url_inspire in self._fresh
+
+    def has_query(self, url_inspire):
+        with self._lock:
+            _row = self._db.execute("SELECT 1 FROM queries WHERE url=?", (url_inspire,)).fetchone()
+        if _row is None and self.fallback:
+            return self.fallback.has_query(url_inspire)
+        return _row is not None
 
     def read_query(self, url_inspire):
         if self.verbose:
             print("[i] checking cache...", file=sys.stderr)
-        with open(self.cache_file, "r") as _fcache:
-            db = _fcache.readlines()
-        file_to_read = None
-        for l in db:
-            if "[*url]={}".format(url_inspire) in l:
-                file_to_read = l.split("[*file]=")[1].strip("\n")
-        if file_to_read is None:
+        with self._lock:
+            _row = self._db.execute("SELECT data, codec FROM queries WHERE url=?", (url_inspire,)).fetchone()
+            if _row is None and self.fallback:
+                return self.fallback.read_query(url_inspire)
+            if _row is not None and url_inspire not in self._accessed and not self.read_only:
+                # once per run is enough for LRU eviction
+                self._accessed.add(url_inspire)
+                self._db.execute("UPDATE queries SET accessed=? WHERE url=?", (time.time(), url_inspire))
+        if _row is None:
             if self.verbose:
                 print("[i] no cached result", file=sys.stderr)
             return None
-        with open(file_to_read, "rb") as _ffeed:
-            feedr = _ffeed.read()
         if self.verbose:
-            print(
-                "[i] using cached result from {}".format(file_to_read), file=sys.stderr
-            )
-        return feedr
+            print("[i] using cached result for {}".format(url_inspire), file=sys.stderr)
+        return decode_blob(_row[0], _row[1])
 
+    # a purged url is no longer fresh for this run either - the next lookup fetches it again
     def purge(self, url_inspire):
-        if self.read_query(url_inspire=url_inspire):
-            if self.verbose:
-                print("[i] checking cache for duplicates...", file=sys.stderr)
-            with open(self.cache_file, "r") as _fcache:
-                # db = [l.strip('\n') for l in _fcache.readlines()]
+        with self._lock:
+            self._db.execute("DELETE FROM queries WHERE url=?", (url_inspire,))
+            self._fresh.discard(url_inspire)
+
+    def stats(self):
+        _stats = {"file": self.cache_file}
+        with self._lock:
+            for _table in ["queries", "snapshots", "aliases", "citations", "negatives"]:
+                _stats[_table] = self._db.execute("SELECT COUNT(*) FROM {}".format(_table)).fetchone()[0]
+            _row = self._db.execute("SELECT SUM(LENGTH(data)), MIN(fetched), MAX(fetched) FROM queries").fetchone()
+            _stats["codecs"] = dict(
+                self._db.execute("SELECT COALESCE(codec, 'raw (legacy)'), COUNT(*) FROM queries GROUP BY codec").fetchall()
+            )
+        _stats["blob_bytes"] = _row[0] or 0
+        _stats["oldest"] = _row[1]
+        _stats["newest"] = _row[2]
+        _stats["file_bytes"] = os.path.getsize(self.cache_file)
+        _legacy = self.legacy_files()
+        _stats["legacy_files"] = len(_legacy)
+        _stats["legacy_bytes"] = sum([os.path.getsize(_f) for _f in _legacy])
+        return _stats
+
+    # evict entries older than max_age seconds, then least recently used ones until the blobs fit in max_size bytes
+    # vacuum=False leaves the freed pages for sqlite to reuse instead of rewriting the file under the exclusive lock
+    def gc(self, max_size=None, max_age=None, dry_run=False, vacuum=True):
+        with self.file_lock("gc"):
+            return self.gc_locked(max_size=max_size, max_age=max_age, dry_run=dry_run, vacuum=vacuum)
+
+    def gc_locked(self, max_size=None, max_age=None, dry_run=False, vacuum=True):
+        _evict = []
+        with self._lock:
+            _rows = self._db.execute(
+                "SELECT url, LENGTH(data), fetched, COALESCE(accessed, fetched) FROM queries ORDER BY COALESCE(accessed, fetched)"
+            ).fetchall()
+        _now = time.time()
+        _kept = []
+        for _url, _size, _fetched, _used in _rows:
+            if max_age is not None and (_fetched is None or _now - _fetched > max_age):
+                _evict.append((_url, _size))
+            else:
+                _kept.append((_url, _size))
+        if max_size is not None:
+            _total = sum([_size for _, _size in _kept])
+            for _url, _size in _kept:
+                if _total <= max_size:
+                    break
+                _evict.append((_url, _size))
+                _total -= _size
+        _result = {"evicted": len(_evict), "evicted_bytes": sum([_size for _, _size in _evict])}
+        if dry_run:
+            _result["orphaned_snapshots"] = self.orphaned_snapshots(dry_run=True, evicted=set([_url for _url, _ in _evict]))
+            _result["legacy_files"] = len(self.legacy_files())
+            return _result
+        with self.transaction():
+            self._db.executemany("DELETE FROM queries WHERE url=?", [(_url,) for _url, _ in _evict])
+            if max_age is not None:
+                _cursor = self._db.execute("DELETE FROM citations WHERE fetched IS NULL OR fetched < ?", (_now - max_age,))
+                _result["evicted_counts"] = _cursor.rowcount
+                _cursor = self._db.execute("DELETE FROM negatives WHERE created < ?", (_now - max_age,))
+                _result["evicted_negatives"] = _cursor.rowcount
+            _result["orphaned_snapshots"] = self.orphaned_snapshots()
+        with self.file_lock("migrate"):
+            _result["legacy_files"] = self.sweep_legacy()
+        _deleted = _result["evicted"] + _result.get("evicted_counts", 0) + _result.get("evicted_negatives", 0) + _result["orphaned_snapshots"]
+        if vacuum and _deleted > 0:
+            with self._lock:
+                self._db.execute("VACUUM")
+        return _result
+
+    # snapshots whose json blob is gone or has changed since
+    def orphaned_snapshots(self, dry_run=False, evicted=set()):
+        _where = (
+            "WHERE NOT EXISTS (SELECT 1 FROM queries WHERE queries.url=snapshots.url AND "
+            "(queries.hash IS NULL OR queries.hash=snapshots.blob_hash))"
+        )
+        with self._lock:
+            if dry_run:
+                _n = self._db.execute("SELECT COUNT(*) FROM snapshots " + _where).fetchone()[0]
+                _urls = self._db.execute("SELECT url FROM snapshots " + _where.replace("WHERE NOT", "WHERE")).fetchall()
+                return _n + len([_url for (_url,) in _urls if _url in evicted])
+            return self._db.execute("DELETE FROM snapshots " + _where).rowcount
+
+    # cache.db index files and the blobs next to them left by versions before the sqlite store
+    def legacy_files(self):
+        _files = []
+        for _fdb in Path(self.cache_dir).rglob("cache.db"):
+            _files.append(str(_fdb))
+            for _f in _fdb.parent.iterdir():
+                if _f.is_file() and _f.name.startswith("tmp"):
+                    _files.append(str(_f))
+        return _files
+
+    # remove the legacy files once their content is in the sqlite store (and empty per-record dirs)
+    def sweep_legacy(self):
+        if self.get_meta("legacy_migrated") is None:
+            return 0
+        _files = self.legacy_files()
+        for _f in _files:
+            os.remove(_f)
+        for _dir in sorted(set([os.path.dirname(_f) for _f in _files]), key=len, reverse=True):
+            if os.path.abspath(_dir) != os.path.abspath(self.cache_dir) and len(os.listdir(_dir)) == 0:
+                os.rmdir(_dir)
+        return len(_files)
+
+    # pack all entries (or the ones for the given recids) into a single sqlite file, blobs compressed with codec
+    def export_bundle(self, filename, recids=None, codec="lzma"):
+        _tmp = filename + ".tmp"
+        if os.path.exists(_tmp):
+            os.remove(_tmp)
+        bundle = Cache(file=_tmp, codec=codec, journal_mode="delete", verbose=self.verbose)
+        _recids = None
+        if recids is not None:
+            _recids = set([str(_recid) for _recid in recids])
+        _literature = re.compile(r"/api/literature/(\d+)\?")
+        with self._lock:
+            _rows = self._db.execute("SELECT url, data, fetched, etag, last_modified, codec FROM queries").fetchall()
+            _aliases = self._db.execute("SELECT alias, recid FROM aliases").fetchall()
+            _counts = self._db.execute("SELECT recid, count, fetched FROM citations").fetchall()
+            _snapshots = self._db.execute("SELECT recid, url, blob_hash, data, version FROM snapshots").fetchall()
+        _n = 0
+        with bundle.transaction():
+            for _url, _data, _fetched, _etag, _last_modified, _codec in _rows:
+                if _recids is not None:
+                    m = _literature.search(_url)
+                    if m is None or m.group(1) not in _recids:
+                        continue
+                bundle.save_query(_url, decode_blob(_data, _codec), fetched=_fetched, etag=_etag, last_modified=_last_modified)
+                _n += 1
+            for _alias, _recid in _aliases:
+                if _recids is None or _recid in _recids:
+                    bundle.save_alias(_alias, _recid)
+            for _recid, _count, _fetched in _counts:
+                if _recids is None or _recid in _recids:
+                    bundle.save_citation_count(_recid, _count, fetched=_fetched)
+            for _recid, _url, _blob_hash, _data, _version in _snapshots:
+                if (_recids is None or _recid in _recids) and bundle.blob_hash(_url) == _blob_hash:
+                    bundle._db.execute(
+                        "INSERT OR REPLACE INTO snapshots (recid, url, blob_hash, data, version) VALUES (?, ?, ?, ?, ?)",
+                        (_recid, _url, _blob_hash, _data, _version),
+                    )
+        bundle._db.close()
+        os.replace(_tmp, filename)
+        return _n
+
+    # entries from another cache file (bundle, cache.sqlite of another cache dir or shard) - the more recently fetched copy wins
+    def import_bundle(self, filename):
+        if not os.path.exists(filename):
+            raise FileNotFoundError(filename)
+        _result = {}
+        with self.file_lock("import"):
+            with self._lock:
+                # read-only: a bundle on read-only media or the cache of another shard is never modified
+                self._db.execute("ATTACH DATABASE ? AS bundle", (sqlite_uri(filename, mode="ro"),))
+                self._db.create_function("canonical_arxiv_id", 1, canonical_arxiv_id, deterministic=True)
+                try:
+                    _have = {}
+                    for _table in ["queries", "aliases", "citations", "snapshots"]:
+                        _have[_table] = [_row[1] for _row in self._db.execute("PRAGMA bundle.table_info({})".format(_table))]
+
+                    # columns a file written by an older version lacks read as NULL
+                    def b(table, column):
+                        return "b.{}".format(column) if column in _have[table] else "NULL"
+
+                    with self.transaction():
+                        if _have["queries"]:
+                            _result["queries"] = self._db.execute(
+                                "INSERT OR REPLACE INTO main.queries (url, data, fetched, hash, etag, last_modified, codec) "
+                                "SELECT b.url, b.data, {fetched}, {hash}, {etag}, {last_modified}, {codec} FROM bundle.queries b "
+                                "LEFT JOIN main.queries q ON q.url = b.url "
+                                "WHERE q.url IS NULL OR COALESCE(q.fetched, 0) < COALESCE({fetched}, 0) "
+                                # same fetch time: pick by content hash so the merge order does not matter
+                                "OR (COALESCE(q.fetched, 0) = COALESCE({fetched}, 0) AND COALESCE({hash}, '') > COALESCE(q.hash, ''))".format(
+                                    **{_c: b("queries", _c) for _c in ["fetched", "hash", "etag", "last_modified", "codec"]}
+                                )
+                            ).rowcount
+                        if _have["aliases"]:
+                            # keys written before they were normalized are normalized on the way in
+                            _result["aliases"] = self._db.execute(
+                                "INSERT OR IGNORE INTO main.aliases (alias, recid) SELECT canonical_arxiv_id(b.alias), b.recid FROM bundle.aliases b"
+                            ).rowcount
+                        if _have["citations"]:
+                            _result["citations"] = self._db.execute(
+                                "INSERT OR REPLACE INTO main.citations (recid, count, fetched) "
+                                "SELECT b.recid, b.count, {fetched} FROM bundle.citations b "
+                                "LEFT JOIN main.citations c ON c.recid = b.recid "
+                                "WHERE c.recid IS NULL OR COALESCE(c.fetched, 0) < COALESCE({fetched}, 0)".format(fetched=b("citations", "fetched"))
+                            ).rowcount
+                        if _have["snapshots"]:
+                            # snapshots stay valid only if they were built from the blob now in the cache
+                            _result["snapshots"] = self._db.execute(
+                                "INSERT OR REPLACE INTO main.snapshots (recid, url, blob_hash, data, version) "
+                                "SELECT b.recid, b.url, b.blob_hash, b.data, {version} FROM bundle.snapshots b "
+                                "JOIN main.queries q ON q.url = b.url AND q.hash = b.blob_hash "
+                                "WHERE NOT EXISTS (SELECT 1 FROM main.snapshots s WHERE s.recid = b.recid AND s.blob_hash = b.blob_hash "
+                                "AND COALESCE(s.version, 0) >= COALESCE({version}, 0))".format(version=b("snapshots", "version"))
+                            ).rowcount
+                finally:
+                    self._db.execute("DETACH DATABASE bundle")
+        return _result
+
+    # aliases written before the keys were normalized
+    def canonicalize_aliases(self):
+        with self.transaction():
+            _rows = self._db.execute("SELECT alias, recid FROM aliases").fetchall()
+            for _alias, _recid in _rows:
+                if canonical_arxiv_id(_alias) != _alias:
+                    self._db.execute("DELETE FROM aliases WHERE alias=?", (_alias,))
+                    self.save_alias(_alias, _recid)
+            self.set_meta("aliases_canonical", time.time())
+
+    # import the old per-record .cache/<id>/cache.db text logs (last entry wins)
+    def migrate_legacy(self):
+        _legacy = [str(p) for p in Path(self.cache_dir).rglob("cache.db")]
+        _n = 0
+        for _fdb in tqdm.tqdm(_legacy, desc="migrating legacy cache", disable=len(_legacy) < 1):
+            with open(_fdb, "r") as _fcache:
                 db = _fcache.readlines()
-            entries = []
-            for l in db:
-                if "[*url]={}".format(url_inspire) in l:
-                    entries.append(l)
-            if len(entries) < 2:
-                return
-            if self.verbose:
-                print("[i] last entry:", entries[-1].strip("\n"), file=sys.stderr)
-                print("    duplicates:", entries[:-1], file=sys.stderr)
-            new_db = []
-            files_to_delete = []
+            entries = {}
             for l in db:
-                if "[*url]={}".format(url_inspire) in l:
-                    if l == entries[-1]:
-                        new_db.append(l)
-                    else:
-                        file_name_from_entry = l.split("[*file]=")[1].strip("\n")
-                        files_to_delete.append(file_name_from_entry)
+                if not l.startswith("[*url]=") or "[*file]=" not in l:
+                    continue
+                _url = l.split("[*file]=")[0][len("[*url]="):].strip()
+                entries[_url] = l.split("[*file]=")[1].strip("\n")
+            _entries = []
+            for _url, _fname in entries.items():
+                if not os.path.exists(_fname):
+                    _fname = os.path.join(os.path.dirname(_fdb), os.path.basename(_fname))
+                if not os.path.exists(_fname):
+                    continue
+                with open(_fname, "rb") as _ffeed:
+                    feedr = _ffeed.read()
+                _entries.append((_url, feedr, os.path.getmtime(_fname)))
+            with self.transaction():
+                for _url, feedr, _fetched in _entries:
+                    self.save_query(_url, feedr, fetched=_fetched)
+                    _n += 1
+        if _n > 0:
+            print("[i] migrated", _n, "legacy cache entries into", self.cache_file, file=sys.stderr)
+        self.set_meta("legacy_migrated", time.time())
+
+
+# --- fetch_policy.py
+
+# timeouts, retry backoff and the per-run deadline shared by all fetchers
+class FetchPolicy(GenericObject):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.connect_timeout is None:
+            self.connect_timeout = 10.0
+        if self.read_timeout is None:
+            self.read_timeout = 60.0
+        if self.retries is None:
+            self.retries = 3
+        if self.backoff is None:
+            self.backoff = 0.5
+        if self.negative_ttl is None:
+            self.negative_ttl = 86400.0
+        self._lock = threading.Lock()
+        self._t_deadline = None
+        if self.deadline:
+            self._t_deadline = time.monotonic() + self.deadline
+        self._deadline_reported = False
+        self.degraded_urls = set()
+        self.failures = {}
+
+    def remaining(self):
+        if self._t_deadline is None:
+            return None
+        return max(0, self._t_deadline - time.monotonic())
+
+    def expired(self):
+        if self.remaining() != 0:
+            return False
+        with self._lock:
+            if not self._deadline_reported:
+                self._deadline_reported = True
+                print("[w] run deadline of {}s reached - serving the rest from cache only".format(self.deadline), file=sys.stderr)
+        return True
+
+    # exponential backoff with full jitter, never sleeping past the deadline
+    def retry_delay(self, attempt):
+        _delay = self.backoff * (2 ** attempt)
+        _delay = _delay / 2.0 + random.uniform(0, _delay / 2.0)
+        if self.remaining() is not None:
+            _delay = min(_delay, self.remaining())
+        return _delay
+
+    def mark_degraded(self, url_inspire):
+        with self._lock:
+            self.degraded_urls.add(url_inspire)
+
+    def is_degraded(self, url_inspire):
+        with self._lock:
+            return url_inspire in self.degraded_urls
+
+    # --offline: nothing is fetched, everything comes from the cache (or --bundle)
+    def refuse_offline(self, url_inspire):
+        if not self.offline:
+            return False
+        self.mark_degraded(url_inspire)
+        with self._lock:
+            if not self._offline_reported:
+                self._offline_reported = True
+                print("[w] offline - serving from cache only, missing entries are reported as degraded", file=sys.stderr)
+        return True
+
+    # permanent (non-retryable) errors by url
+    def mark_failed(self, url_inspire, reason):
+        with self._lock:
+            self.failures[url_inspire] = reason
+
+    def failure(self, url_inspire):
+        with self._lock:
+            return self.failures.get(url_inspire)
+
+
+def fetch_policy():
+    global gFetchPolicy
+    if gFetchPolicy is None:
+        gFetchPolicy = FetchPolicy()
+    return gFetchPolicy
+
+
+# --download refreshes every cached url, --refresh-older-than only the ones past the TTL
+def needs_refresh(cache, url_inspire, download=False):
+    if cache.is_fresh(url_inspire) or fetch_policy().offline:
+        return False
+    if download:
+        return True
+    return cache.is_stale(url_inspire, fetch_policy().refresh_older_than)
+
+
+def needs_count_refresh(cache, recid, download=False):
+    if cache.is_fresh_count(recid) or fetch_policy().offline:
+        return False
+    if download:
+        return True
+    return cache.is_stale_count(recid, fetch_policy().refresh_older_than)
+
+
+# "2/8" -> (2, 8)
+def parse_shard(s):
+    try:
+        _i, _n = [int(_x) for _x in str(s).split("/")]
+    except ValueError:
+        raise ValueError(f"shard should be i/N, got {s}")
+    if _n < 1 or _i < 1 or _i > _n:
+        raise ValueError(f"shard {s} out of range - i/N with 1 <= i <= N")
+    return _i, _n
+
+
+# 500M, 2G, 100k - a plain number means bytes
+def parse_size(s):
+    if s is None:
+        return None
+    _units = {"k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+    s = str(s).strip().lower().rstrip("b")
+    if s and s[-1] in _units:
+        return int(float(s[:-1]) * _units[s[-1]])
+    return int(s)
+
+
+# 7d, 12h, 30m, 45s - a plain number means days
+def parse_age(s):
+    if s is None:
+        return None
+    _units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+    s = str(s).strip().lower()
+    if s and s[-1] in _units:
+        return float(s[:-1]) * _units[s[-1]]
+    return float(s) * _units["d"]
+
+
+# --- single_flight.py
+
+# concurrent callers with the same key wait for one call and share its result (or its exception)
+class SingleFlight(GenericObject):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.n_shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            _call = self._calls.get(key)
+            _leader = _call is None
+            if _leader:
+                _call = GenericObject(done=threading.Event())
+                self._calls[key] = _call
+            else:
+                self.n_shared += 1
+        if not _leader:
+            _call.done.wait()
+            if _call.error is not None:
+                raise _call.error
+            return _call.result
+        try:
+            _call.result = fn()
+        except BaseException as e:
+            _call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            _call.done.set()
+        return _call.result
+
+
+def single_flight():
+    global gSingleFlight
+    if gSingleFlight is None:
+        gSingleFlight = SingleFlight()
+    return gSingleFlight
+
+
+# --- rate_limiter.py
+
+# process-wide token bucket - every request from every thread / coroutine takes a token first
+class RateLimiter(GenericObject):
+    throttle_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.rate is None:
+            self.rate = 3.0
+        if self.burst is None:
+            self.burst = 15
+        self._lock = threading.Lock()
+        self._current_rate = self.rate
+        self._tokens = self.burst
+        self._t_last = time.monotonic()
+        self._blocked_until = 0
+        self.n_throttled = 0
+
+    # reserve one token and return how long the caller has to wait for it
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = 0
+            if self.rate > 0:
+                self._tokens = min(self.burst, self._tokens + (now - self._t_last) * self._current_rate)
+                self._t_last = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = -self._tokens / self._current_rate
+            return max(wait, self._blocked_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    # the server pushed back: halve the rate and hold everybody for Retry-After (or a short backoff)
+    def penalize(self, retry_after=None):
+        _delay = None
+        if retry_after:
+            try:
+                _delay = float(retry_after)
+            except ValueError:
+                try:
+                    _delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    _delay = None
+        with self._lock:
+            self.n_throttled += 1
+            if self.rate > 0:
+                self._current_rate = max(self.rate / 16.0, self._current_rate / 2.0)
+                self._tokens = min(self._tokens, 0)
+            if _delay is None:
+                _delay = 1.0 if self.rate <= 0 else 1.0 / self._current_rate
+            self._blocked_until = max(self._blocked_until, time.monotonic() + max(0, _delay))
+
+    # recover towards the configured rate after successful requests
+    def reward(self):
+        with self._lock:
+            if self.rate > 0 and self._current_rate < self.rate:
+                self._current_rate = min(self.rate, self._current_rate + self.rate / 20.0)
+
+    def stats(self):
+        return "rate {:.2f}/s (configured {:.2f}/s, burst {}), {} throttled responses".format(
+            self._current_rate, self.rate, self.burst, self.n_throttled
+        )
+
+
+def rate_limiter():
+    global gRateLimiter
+    if gRateLimiter is None:
+        gRateLimiter = RateLimiter()
+    return gRateLimiter
+
+
+# --- http_pool.py
+
+# http_proxy / https_proxy / no_proxy as urllib.request.urlopen honours them -> (host, port, Proxy-Authorization) or None
+def proxy_for(scheme, host):
+    _proxy = urllib.request.getproxies().get(scheme)
+    if not _proxy or urllib.request.proxy_bypass(host):
+        return None
+    if "://" not in _proxy:
+        _proxy = "http://" + _proxy
+    _parts = urllib.parse.urlsplit(_proxy)
+    _auth = None
+    if _parts.username:
+        _credentials = "{}:{}".format(urllib.parse.unquote(_parts.username), urllib.parse.unquote(_parts.password or ""))
+        _auth = "Basic " + base64.b64encode(_credentials.encode("utf-8")).decode("ascii")
+    return _parts.hostname, _parts.port or 80, _auth
+
+
+# a reused keep-alive connection the server closed while idle - http_get_steps sends the request again on a new one
+class StaleConnection(Exception):
+    pass
+
+
+# persistent (keep-alive) connections per host, shared by all fetching threads - the blocking transport of http_get_steps
+class HTTPConnectionPool(GenericObject):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.pool_size is None:
+            self.pool_size = multiprocessing.cpu_count() * 2
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._proxies = {}
+        self.n_requests = 0
+        self.n_connections = 0
+        self.n_reused = 0
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.pool_size)
+            return self._slots[key]
+
+    def _proxy(self, key):
+        with self._lock:
+            if key not in self._proxies:
+                self._proxies[key] = proxy_for(key[0], key[1])
+            return self._proxies[key]
+
+    def _get_connection(self, key, reuse=True):
+        with self._lock:
+            self.n_requests += 1
+            _idle = self._idle.setdefault(key, [])
+            if reuse and _idle:
+                self.n_reused += 1
+                return _idle.pop(), True
+            self.n_connections += 1
+        _scheme, _host, _port = key
+        _proxy = self._proxy(key)
+        if _proxy is None:
+            _host_port = (_host, _port)
+        else:
+            _host_port = _proxy[:2]
+        if _scheme == "https":
+            conn = http.client.HTTPSConnection(*_host_port, timeout=fetch_policy().connect_timeout)
+            if _proxy is not None:
+                # TLS to the server inside a CONNECT tunnel through the proxy
+                conn.set_tunnel(_host, _port, headers={"Proxy-Authorization": _proxy[2]} if _proxy[2] else None)
+        else:
+            conn = http.client.HTTPConnection(*_host_port, timeout=fetch_policy().connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(fetch_policy().read_timeout)
+        return conn, False
+
+    def _release(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    # one exchange on a pooled connection -> (status, headers, body)
+    def request_once(self, key, path, headers, reuse=True):
+        _proxy = self._proxy(key)
+        if _proxy is not None and key[0] == "http":
+            # a plain http proxy takes the absolute url
+            path = "http://{}{}".format(headers["Host"], path)
+            if _proxy[2]:
+                headers = dict(headers, **{"Proxy-Authorization": _proxy[2]})
+        with self._slot(key):
+            conn, reused = self._get_connection(key, reuse=reuse)
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if reused:
+                    raise StaleConnection()
+                raise
+            except:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            return resp.status, resp.headers, body
+
+    def get_response(self, url, headers=None):
+        return run_steps(http_get_steps(url, headers=headers), self.request_once)
+
+    def get(self, url, headers=None):
+        return self.get_response(url, headers=headers)[2]
+
+    def stats(self):
+        return "{} requests, {} connections opened (handshakes), {} reused".format(
+            self.n_requests, self.n_connections, self.n_reused
+        )
+
+
+def http_pool():
+    global gHTTPPool
+    if gHTTPPool is None:
+        gHTTPPool = HTTPConnectionPool()
+    return gHTTPPool
+
+
+# --- fetch_steps.py
+
+# errors a transport may raise into the steps below
+gFetchErrors = (urllib.error.URLError, http.client.HTTPException, asyncio.IncompleteReadError, asyncio.TimeoutError, OSError)
+gMaxRedirects = 5
+
+
+def is_retryable(e):
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code in RateLimiter.throttle_status
+    return isinstance(e, gFetchErrors)
+
+
+# The fetch policy is written once, as generators of transport steps, and shared by both engines:
+#   ("sleep", seconds)                         - wait for the rate limiter or a retry backoff
+#   ("request", key, path, headers, reuse)     - one exchange, answered with (status, headers, body)
+# run_steps() drives them with the blocking HTTPConnectionPool, run_steps_async() with the AsyncHTTPClient.
+
+# one GET with redirects; the rate limiter is held back by throttled responses
+def http_get_steps(url, headers=None):
+    _headers = {"User-Agent": "lblpmp-inspireq", "Accept-Encoding": "identity", "Connection": "keep-alive"}
+    if headers:
+        _headers.update(headers)
+    for _ in range(gMaxRedirects + 1):
+        _parts = urllib.parse.urlsplit(url)
+        _port = _parts.port or (443 if _parts.scheme == "https" else 80)
+        key = (_parts.scheme, _parts.hostname, _port)
+        path = _parts.path or "/"
+        if _parts.query:
+            path = path + "?" + _parts.query
+        # with a non-default port - the server builds redirects from it
+        _headers["Host"] = _parts.netloc.rsplit("@", 1)[-1]
+        yield ("sleep", rate_limiter().reserve())
+        try:
+            try:
+                status, resp_headers, body = yield ("request", key, path, _headers, True)
+            except StaleConnection:
+                status, resp_headers, body = yield ("request", key, path, _headers, False)
+        except (http.client.IncompleteRead, http.client.RemoteDisconnected, asyncio.IncompleteReadError):
+            raise
+        except asyncio.TimeoutError:
+            raise urllib.error.URLError("timed out")
+        except OSError as e:
+            raise urllib.error.URLError(e)
+        if status in (301, 302, 303, 307, 308) and resp_headers.get("Location"):
+            url = urllib.parse.urljoin(url, resp_headers.get("Location"))
+            continue
+        if status in RateLimiter.throttle_status:
+            rate_limiter().penalize(resp_headers.get("Retry-After"))
+        else:
+            rate_limiter().reward()
+        if status >= 400:
+            raise urllib.error.HTTPError(url, status, http.client.responses.get(status, ""), resp_headers, None)
+        return status, resp_headers, body
+    raise urllib.error.URLError(f"too many redirects for {url}")
+
+
+# bounded retries with backoff -> (status, headers, body), or None if the url could not be read
+# (transient failures are marked degraded, permanent ones failed)
+def fetch_steps(url_inspire, headers=None):
+    policy = fetch_policy()
+    if policy.refuse_offline(url_inspire):
+        return None
+    for attempt in range(policy.retries + 1):
+        if policy.expired():
+            policy.mark_degraded(url_inspire)
+            return None
+        try:
+            return (yield from http_get_steps(url_inspire, headers=headers))
+        except gFetchErrors as e:
+            if not is_retryable(e) or attempt == policy.retries:
+                print("[e] unable to read from the web - link tried", url_inspire, file=sys.stderr)
+                print(" . ", e)
+                if is_retryable(e):
+                    policy.mark_degraded(url_inspire)
                 else:
-                    new_db.append(l)
-            with open(self.cache_file, "w") as _fcache:
-                _fcache.writelines(new_db)
-            for _df in files_to_delete:
-                if os.path.exists(_df):
-                    if self.verbose:
-                        print("[w] removing", _df, file=sys.stderr)
-                    os.remove(_df)
+                    policy.mark_failed(url_inspire, str(e))
+                return None
+            print("[w] {} - retrying {} ({}/{})".format(e, url_inspire, attempt + 1, policy.retries), file=sys.stderr)
+            if not isinstance(e, urllib.error.HTTPError):
+                # throttled responses already hold the rate limiter
+                yield ("sleep", policy.retry_delay(attempt))
+    return None
+
+
+# fetch a url into the cache - a conditional GET if the cached copy has validators, a 304 only refreshes its timestamp;
+# a url that failed for good is remembered as a negative entry
+def revalidate_steps(url_inspire, cache):
+    _response = yield from fetch_steps(url_inspire, headers=cache.validators(url_inspire))
+    if _response is None:
+        if not fetch_policy().is_degraded(url_inspire) and fetch_policy().failure(url_inspire):
+            cache.save_negative(url_inspire, fetch_policy().failure(url_inspire))
+        return None
+    status, resp_headers, body = _response
+    if status == 304:
+        cache.touch(url_inspire)
+        return cache.read_query(url_inspire)
+    cache.save_query(url_inspire, body, etag=resp_headers.get("ETag"), last_modified=resp_headers.get("Last-Modified"))
+    return body
+
+
+def run_steps(steps, request):
+    _result, _error = None, None
+    while True:
+        try:
+            _step = steps.throw(_error) if _error is not None else steps.send(_result)
+        except StopIteration as e:
+            return e.value
+        _result, _error = None, None
+        try:
+            if _step[0] == "sleep":
+                if _step[1] > 0:
+                    time.sleep(_step[1])
+            else:
+                _result = request(*_step[1:])
+        except gFetchErrors + (StaleConnection,) as e:
+            _error = e
+
+
+async def run_steps_async(steps, request):
+    _result, _error = None, None
+    while True:
+        try:
+            _step = steps.throw(_error) if _error is not None else steps.send(_result)
+        except StopIteration as e:
+            return e.value
+        _result, _error = None, None
+        try:
+            if _step[0] == "sleep":
+                if _step[1] > 0:
+                    await asyncio.sleep(_step[1])
+            else:
+                _result = await request(*_step[1:])
+        except gFetchErrors + (StaleConnection,) as e:
+            _error = e
+
+
+# None if the url could not be read; threads asking for the same url at the same time share one download
+def fetch_url(url_inspire, headers=None, full_response=False):
+    _key = ("fetch", url_inspire, tuple(sorted((headers or {}).items())), full_response)
+    return single_flight().do(_key, lambda: fetch_url_once(url_inspire, headers=headers, full_response=full_response))
+
+
+def fetch_url_once(url_inspire, headers=None, full_response=False):
+    _response = run_steps(fetch_steps(url_inspire, headers=headers), http_pool().request_once)
+    if _response is None or full_response:
+        return _response
+    return _response[2]
+
+
+def revalidate_url(url_inspire, cache):
+    return single_flight().do(("revalidate", url_inspire), lambda: revalidate_url_once(url_inspire, cache))
+
+
+def revalidate_url_once(url_inspire, cache):
+    return run_steps(revalidate_steps(url_inspire, cache), http_pool().request_once)
+
+
+# --- async_engine.py
+
+# single-threaded HTTP/1.1 client on asyncio streams - keeps many requests in flight over keep-alive connections
+class AsyncHTTPClient(GenericObject):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.concurrency is None:
+            self.concurrency = 100
+        self._idle = {}
+        self._in_flight = None
+        self._ssl = ssl.create_default_context()
+        self.n_requests = 0
+        self.n_connections = 0
+        self.n_reused = 0
+
+    async def _open(self, key):
+        _scheme, _host, _port = key
+        self.n_connections += 1
+        if _scheme == "https":
+            return await asyncio.wait_for(asyncio.open_connection(_host, _port, ssl=self._ssl), fetch_policy().connect_timeout)
+        return await asyncio.wait_for(asyncio.open_connection(_host, _port), fetch_policy().connect_timeout)
+
+    async def _read_response(self, reader):
+        _line = await reader.readline()
+        if not _line:
+            raise http.client.RemoteDisconnected("connection closed without response")
+        status = int(_line.split()[1])
+        headers = http.client.HTTPMessage()
+        while True:
+            _line = await reader.readline()
+            if _line in (b"\r\n", b"\n", b""):
+                break
+            _k, _v = _line.decode("latin-1").split(":", 1)
+            headers[_k.strip()] = _v.strip()
+        will_close = headers.get("Connection", "").lower() == "close"
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            _chunks = []
+            while True:
+                _size = int((await reader.readline()).split(b";")[0], 16)
+                if _size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                _chunks.append(await reader.readexactly(_size))
+                await reader.readexactly(2)
+            body = b"".join(_chunks)
+        elif "Content-Length" in headers:
+            body = await reader.readexactly(int(headers["Content-Length"]))
+        elif status in (204, 304) or status < 200:
+            body = b""
+        else:
+            body = await reader.read()
+            will_close = True
+        return status, headers, body, will_close
+
+    # one exchange on a kept-alive stream -> (status, headers, body)
+    async def request_once(self, key, path, headers, reuse=True):
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self.concurrency)
+        async with self._in_flight:
+            _idle = self._idle.setdefault(key, [])
+            self.n_requests += 1
+            reused = False
+            if reuse and _idle:
+                reader, writer = _idle.pop()
+                reused = True
+                self.n_reused += 1
+            else:
+                reader, writer = await self._open(key)
+            _lines = ["GET {} HTTP/1.1".format(path)]
+            _lines.extend(["{}: {}".format(k, v) for k, v in headers.items()])
+            try:
+                writer.write(("\r\n".join(_lines) + "\r\n\r\n").encode("latin-1"))
+                await writer.drain()
+                status, resp_headers, body, will_close = await asyncio.wait_for(self._read_response(reader), fetch_policy().read_timeout)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    raise StaleConnection()
+                raise
+            except:
+                writer.close()
+                raise
+            if will_close:
+                writer.close()
+            else:
+                _idle.append((reader, writer))
+            return status, resp_headers, body
+
+    async def get_response(self, url, headers=None):
+        return await run_steps_async(http_get_steps(url, headers=headers), self.request_once)
+
+    async def get(self, url, headers=None):
+        return (await self.get_response(url, headers=headers))[2]
+
+    async def close(self):
+        for _conns in self._idle.values():
+            for _, writer in _conns:
+                writer.close()
+        self._idle = {}
+
+    def stats(self):
+        return "{} requests, {} connections opened (handshakes), {} reused".format(
+            self.n_requests, self.n_connections, self.n_reused
+        )
+
+
+# fills the cache with everything InspireRecord.retrieve reads - parsing is left to InspireRecord
+class AsyncFetchEngine(GenericObject):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.cache is None:
+            self.cache = Cache.shared(verbose=self.verbose)
+        self.client = AsyncHTTPClient(concurrency=self.concurrency)
+        self._pending = {}
+        self.n_shared = 0
+
+    # coroutines asking for the same url share one task
+    async def fetch(self, url_inspire, save=True):
+        _task = self._pending.get(url_inspire)
+        if _task is None:
+            _task = asyncio.ensure_future(self.fetch_once(url_inspire, save=save))
+            self._pending[url_inspire] = _task
+            _task.add_done_callback(lambda _t: self._pending.pop(url_inspire, None))
+        else:
+            self.n_shared += 1
+        return await asyncio.shield(_task)
+
+    async def fetch_once(self, url_inspire, save=True):
+        if not needs_refresh(self.cache, url_inspire, self.download) and self.cache.has_query(url_inspire):
+            return self.cache.read_query(url_inspire)
+        if not self.download and self.cache.is_negative(url_inspire, fetch_policy().negative_ttl):
+            return None
+        if save:
+            return await run_steps_async(revalidate_steps(url_inspire, self.cache), self.client.request_once)
+        _response = await run_steps_async(fetch_steps(url_inspire), self.client.request_once)
+        if _response is None:
+            return None
+        return _response[2]
+
+    async def fetch_json(self, url_inspire):
+        feedr = await self.fetch(url_inspire)
+        if feedr is None:
+            return None
+        try:
+            return json.loads(feedr)
+        except ValueError:
+            return None
+
+    async def resolve(self, arxiv_id):
+        if not self.download:
+            _recid = self.cache.read_alias(arxiv_id)
+            if _recid:
+                return _recid
+            if self.cache.is_negative("arxiv:" + arxiv_id, fetch_policy().negative_ttl):
+                return None
+        _urls = [url_search_eprint(arxiv_id), url_arxiv_api(arxiv_id)]
+        for _url in _urls:
+            _js = await self.fetch_json(_url)
+            try:
+                _recid = str(_js["hits"]["hits"][0]["id"])
+            except:
+                continue
+            self.cache.save_alias(arxiv_id, _recid)
+            return _recid
+        if not any([fetch_policy().is_degraded(_url) for _url in _urls]):
+            forget_unresolved_eprint(self.cache, arxiv_id)
+        return None
+
+    async def fetch_record(self, record):
+        _recid = record.inspire_id
+        if record["source"].lower().startswith("inspire"):
+            _recid = "{}".format(record["id"])
+        if _recid is None:
+            _recid = await self.resolve("{}".format(record["id"]))
+            if _recid is None:
+                return record
+            record.inspire_id = _recid
+        _url_json = url_literature_json(_recid, self.projection, self.cache, self.download)
+        _js = await self.fetch_json(_url_json)
+        if _js is None:
+            record.degraded = fetch_policy().is_degraded(_url_json)
+            return record
+        _links = _js.get("links", {})
+        _urls = []
+        if self.groups is None or "latex_us" in self.groups:
+            _urls.append(_links.get("latex-us", url_literature(_recid, "latex-us")))
+        if self.groups is None or "bibtex" in self.groups:
+            _urls.append(_links.get("bibtex", url_literature(_recid, "bibtex")))
+        if (self.groups is None or "refers_to" in self.groups) and not self.cache.is_fresh_count(_recid):
+            if needs_count_refresh(self.cache, _recid, self.download) or self.cache.read_citation_count(_recid) is None:
+                _urls.append(url_refersto_count(_recid))
+        _results = await asyncio.gather(*[self.fetch(_url, save=_url != url_refersto_count(_recid)) for _url in _urls])
+        for _url, feedr in zip(_urls, _results):
+            if feedr is not None and _url == url_refersto_count(_recid):
+                self.cache.save_citation_count(_recid, json.loads(feedr)["hits"]["total"])
+        record.degraded = any([fetch_policy().is_degraded(_url) for _url in _urls])
+        return record
+
+    async def run_async(self, records):
+        pbar = tqdm.tqdm(total=len(records), desc="prescanning records (asyncio)")
+        tasks = [asyncio.ensure_future(self.fetch_record(record)) for record in records]
+        try:
+            for _done in asyncio.as_completed(tasks, timeout=fetch_policy().remaining()):
+                await _done
+                pbar.update(1)
+        except asyncio.TimeoutError:
+            fetch_policy().expired()
+            for _task, record in zip(tasks, records):
+                if not _task.done():
+                    record.degraded = True
+                _task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        pbar.close()
+        await self.client.close()
+
+    def run(self, records):
+        asyncio.run(self.run_async(records))
+        if self.client.n_requests > 0:
+            print("[i] http (asyncio):", self.client.stats(), file=sys.stderr)
+        if self.n_shared > 0:
+            print("[i] {} fetches shared an in-flight request".format(self.n_shared), file=sys.stderr)
+
+
+def url_literature(recid, fmt="json"):
+    return "{}/api/literature/{}?format={}".format(gInspireURL, recid, fmt)
+
+
+# metadata keys read by InspireRecord.retrieve / decode_journal_string and the bulk export stage
+gProjectionFields = [
+    "control_number",
+    "titles",
+    "dois",
+    "arxiv_eprints",
+    "publication_info",
+    "preprint_date",
+    "imprints",
+    "legacy_creation_date",
+    "citation_count",
+    "citation_count_without_self_citations",
+    "citeable",
+    "texkeys",
+]
+
+
+def url_literature_projected(recid):
+    return "{}/api/literature/{}?format=json&fields={}".format(gInspireURL, recid, ",".join(gProjectionFields))
+
+
+# the json url a record is read from - a full document already in the cache also serves a projection
+def url_literature_json(recid, projection=False, cache=None, update=False):
+    if not projection:
+        return url_literature(recid)
+    if cache is not None and not update and not cache.has_query(url_literature_projected(recid)):
+        if cache.has_query(url_literature(recid)):
+            return url_literature(recid)
+    return url_literature_projected(recid)
+
+
+def url_search_eprint(arxiv_id):
+    return "{}/api/literature?sort=mostrecent&size=1&page=1&q=find%20eprint%20{}".format(gInspireURL, arxiv_id)
+
+
+def url_arxiv_api(arxiv_id):
+    return "{}/api/arxiv/{}".format(gInspireURL, arxiv_id)
+
+
+# an eprint no search finds is a negative entry for a while - the empty search page must not hide the record once it is indexed
+def forget_unresolved_eprint(cache, arxiv_id):
+    cache.purge(url_search_eprint(arxiv_id))
+    cache.save_negative("arxiv:" + arxiv_id, "no INSPIRE record for this eprint")
+
+
+def url_refersto(recid):
+    return "{}/api/literature?q=refersto:recid:{}".format(gInspireURL, recid)
+
+
+# only hits.total is used - one minimal hit instead of a full result page
+def url_refersto_count(recid):
+    return "{}/api/literature?size=1&fields=control_number&q=refersto:recid:{}".format(gInspireURL, recid)
+
+
+def url_search(q, **params):
+    _params = "".join(["{}={}&".format(k, v) for k, v in params.items()])
+    return "{}/api/literature?{}q={}".format(gInspireURL, _params, urllib.parse.quote(q))
 
 
 # return dictionary where a=value can be more words 23
@@ -219,7 +1620,7 @@ class InspireRecordData(GenericObject):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         if self.from_string:
-            self.arxiv_id = self.from_string.split()[0]
+            self.arxiv_id = canonical_arxiv_id(self.from_string.split()[0])
             if len(self.from_string.split()) > 1:
                 self.extra_info = " ".join(self.from_string.split()[1:])
         if self.from_record:
@@ -227,38 +1628,83 @@ class InspireRecordData(GenericObject):
             if self.record.source is None:
                 self.record.source = "unknown"
             if self.record.source.lower().startswith("arxiv"):
-                self.arxiv_id = self.record.id
+                self.arxiv_id = canonical_arxiv_id(self.record.id)
             else:
                 self.arxiv_id = None
             if self.record.source.lower().startswith("inspire"):
-                self.inspire_id = self.record.id
+                self.inspire_id = canonical_recid(self.record.id)
             else:
                 self.inspire_id = None
+            if self.record.inspire_id:
+                self.inspire_id = self.record.inspire_id
         _tmpd = get_eq_val(self.extra_info)
         for k in _tmpd:
             self.__setattr__(k, _tmpd[k])
 
+    # fields registered with a loader are fetched on first access
+    def set_lazy(self, fields, loader):
+        if "_loaders" not in self.__dict__:
+            self._loaders = {}
+        for f in fields:
+            self._loaders[f] = loader
+
+    def __getattr__(self, key):
+        _loaders = self.__dict__.get("_loaders")
+        if _loaders and key in _loaders:
+            _loader = _loaders[key]
+            for f in [f for f in _loaders if _loaders[f] is _loader]:
+                del _loaders[f]
+            _loader()
+        return super().__getattr__(key)
+
 
 class InspireRecord(GenericObject):
+    # fields that need an extra request beyond the literature json - group name -> fields
+    lazy_groups = {
+        "latex_us": ["url_latex_us", "latex_us"],
+        "bibtex": ["url_bibtex", "bibtex"],
+        "refers_to": ["refers_to", "refers_to_count"],
+    }
+    # parse_record_json results kept in the snapshot table - bump snapshot_version when the parsing changes
+    snapshot_version = 2
+    snapshot_fields = [
+        "record_links",
+        "arxiv_id",
+        "arxiv_id_check",
+        "doi",
+        "url_doi",
+        "journal_info",
+        "preprint_date",
+        "pub_date",
+        "created_date",
+        "created_date_noT",
+        "updated_date",
+        "legacy_creation_date",
+        "date_guess",
+        "citation_count_wsc",
+        "citation_count",
+        "title",
+        "url_arxiv",
+        "citeable",
+        "texkeys",
+    ]
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         if self.from_string:
             self.data = InspireRecordData(from_string=self.from_string, verbose=self.verbose)
         if self.from_record:
             self.data = InspireRecordData(from_record=self.from_record, verbose=self.verbose)
-        if self.cache_dir is None:
-            _id = None
-            if self.data.arxiv_id:
-                _id = self.data.arxiv_id
-            if self.data.inspire_id:
-                _id = self.data.inspire_id
-            if _id:
-                self.cache_dir = os.path.join("./.cache", _id)
+        _id = None
+        if self.data.arxiv_id:
+            _id = self.data.arxiv_id
+        if self.data.inspire_id:
+            _id = self.data.inspire_id
         if self.verbose:
             print("[i] data", self.data)
             print("[i] cache dir", self.cache_dir)
-        if self.cache_dir:
-            self.cache = Cache(dir=self.cache_dir, verbose=self.verbose)
+        if _id:
+            self.cache = Cache.shared(dir=self.cache_dir, verbose=self.verbose)
             self.is_valid = True
             _ = self.retrieve()
         else:
@@ -337,9 +1783,15 @@ class InspireRecord(GenericObject):
         if self.data.arxiv_id is None:
             print(f'[e] no arxiv id ? {self.data.arxiv_id}')
             return None
-        self.data.url_insp_search_abs_id = "https://inspirehep.net/api/literature?sort=mostrecent&size=1&page=1&q=find%20eprint%20{}".format(
-            self.data.arxiv_id
-        )
+        if not self.update:
+            _recid = self.cache.read_alias(self.data.arxiv_id)
+            if _recid:
+                return _recid
+            if self.cache.is_negative("arxiv:" + self.data.arxiv_id, fetch_policy().negative_ttl):
+                self.data.arxiv2inspire_failed = 3
+                self.data.inspire_not_found = True
+                return None
+        self.data.url_insp_search_abs_id = url_search_eprint(self.data.arxiv_id)
         self.data.inspire_record = self.query(self.data.url_insp_search_abs_id)
         self.data.arxiv2inspire_failed = 0
         try:
@@ -351,13 +1803,13 @@ class InspireRecord(GenericObject):
         if self.data.arxiv2inspire_failed == 1:
             if self.get_extra_info("inspire_id"):
                 self.data.inspire_id = self.get_extra_info("inspire_id")
-                self.data.api_url_record = "https://inspirehep.net/api/literature/{}".format(self.data.inspire_id)
-                self.data.url_json = self.data.api_url_record + "?format=json"
+                self.data.api_url_record = "{}/api/literature/{}".format(gInspireURL, self.data.inspire_id)
+                self.data.url_json = url_literature(self.data.inspire_id)
             else:
                 self.data.arxiv2inspire_failed = 2
 
         if self.data.arxiv2inspire_failed == 2:
-            self.data.url_insp_arxiv_api = f'https://inspirehep.net/api/arxiv/{self.data.arxiv_id}'
+            self.data.url_insp_arxiv_api = url_arxiv_api(self.data.arxiv_id)
             self.data.inspire_record = self.query(self.data.url_insp_arxiv_api)
             try:
                 self.data.inspire_id = self.data.inspire_record["hits"]["hits"][0]["id"]
@@ -367,7 +1819,10 @@ class InspireRecord(GenericObject):
 
         if self.data.arxiv2inspire_failed == 3:
             self.data.inspire_not_found = True
+            if not self.data.degraded:
+                forget_unresolved_eprint(self.cache, self.data.arxiv_id)
             return None
+        self.cache.save_alias(self.data.arxiv_id, self.data.inspire_id)
         return self.data.inspire_id
 
     def retrieve(self):
@@ -377,22 +1832,30 @@ class InspireRecord(GenericObject):
                 print(f'[e] no inspire id found for [{self.data.arxiv_id}]')
                 self.is_valid = False
                 return None
-        self.data.url_record = "https://inspirehep.net/literature/{}".format(self.data.inspire_id)
+        self.data.url_record = "{}/literature/{}".format(gInspireURL, self.data.inspire_id)
         if self.data.url_inspire is None:
             self.data.url_inspire = self.data.url_record
-        self.data.api_url_record = "https://inspirehep.net/api/literature/{}".format(self.data.inspire_id)
-        self.data.url_json = self.data.api_url_record + "?format=json"
-        self.data.inspire_record_json = self.query(self.data.url_json)
-        # from here on one can use self.q('something.subsomething)
-        self.data.url_latex_us = self.q("links.latex-us")
-        self.data.latex_us = self.query(self.data.url_latex_us, parse_json=False)  # .decode("utf-8") # this should be TEXT not json!
-        if isinstance(self.data.latex_us, bytes):
-            self.data.latex_us = self.data.latex_us.decode('utf-8')        
-        self.data.url_bibtex = self.q("links.bibtex")
-        self.data.bibtex = self.query(self.data.url_bibtex, parse_json=False)  # .decode("utf-8") # this should be TEXT not json!
-        if isinstance(self.data.bibtex, bytes):
-            self.data.bibtex = self.data.bibtex.decode('utf-8')        
+        self.data.api_url_record = "{}/api/literature/{}".format(gInspireURL, self.data.inspire_id)
+        self.data.url_json = url_literature_json(self.data.inspire_id, self.projection, self.cache, self.update)
+        self.data.projected = self.data.url_json != url_literature(self.data.inspire_id)
+        if not self.apply_snapshot():
+            self.data.inspire_record_json = self.query(self.data.url_json)
+            # from here on one can use self.q('something.subsomething)
+            self.parse_record_json()
+            self.save_snapshot()
+        _loaders = {
+            "latex_us": self.load_latex_us,
+            "bibtex": self.load_bibtex,
+            "refers_to": self.load_refers_to,
+        }
+        for _group, _loader in _loaders.items():
+            if self.groups is None or _group in self.groups:
+                _loader()
+            else:
+                self.data.set_lazy(InspireRecord.lazy_groups[_group], _loader)
 
+    def parse_record_json(self):
+        self.data.record_links = self.q("links")
         # self.data.doi = self.inspire_record_json["metadata"]["dois"][0]["value"]
         self.data.doi = self.q("metadata.dois.0.value")
         if self.data.doi:
@@ -403,6 +1866,9 @@ class InspireRecord(GenericObject):
             )  # this might be unexpected - check doi first
         self.decode_journal_string()
         self.data.arxiv_id_check = self.q("metadata.arxiv_eprints.0.value")
+        if self.data.arxiv_id_check:
+            # a later --absid / arXiv input for this paper resolves without a search
+            self.cache.save_alias(self.data.arxiv_id_check, self.data.inspire_id)
         if self.data_arxiv_id is None:
             self.data.arxiv_id = self.data.arxiv_id_check
         if self.data_arxiv_id != self.data_arxiv_id_check:
@@ -429,11 +1895,6 @@ class InspireRecord(GenericObject):
         )
         self.data.citation_count = self.q("metadata.citation_count")
 
-        self.data.refers_to = self.query(
-            f"https://inspirehep.net/api/literature?q=refersto:recid:{self.data.inspire_id}"
-        )
-        self.data.refers_to_count = self.data.refers_to["hits"]["total"]
-
         try:
             self.data.title = self.data.inspire_record_json["metadata"]["titles"][0]["title"]
         except:
@@ -448,12 +1909,104 @@ class InspireRecord(GenericObject):
         except:
             pass
         self.data.citeable = self.q("metadata.citeable")
+        self.data.texkeys = self.q("metadata.texkeys")
+
+    # flattened parse_record_json results, reused while the cached json blob is unchanged
+    def apply_snapshot(self):
+        if needs_refresh(self.cache, self.data.url_json, self.update):
+            return False
+        _snapshot = self.cache.read_snapshot(self.data.inspire_id, self.data.url_json, InspireRecord.snapshot_version)
+        if _snapshot is None or not all([k in _snapshot for k in InspireRecord.snapshot_fields]):
+            return False
+        for k in InspireRecord.snapshot_fields:
+            self.data.__setattr__(k, _snapshot.get(k))
+        if _snapshot.get("is_valid") is False:
+            self.is_valid = False
+        self.data.set_lazy(["inspire_record_json"], self.load_record_json)
+        return True
+
+    def save_snapshot(self):
+        if self.data.inspire_record_json is None:
+            return
+        _snapshot = {k: self.data.__dict__.get(k) for k in InspireRecord.snapshot_fields}
+        _snapshot["is_valid"] = self.is_valid
+        self.cache.save_snapshot(self.data.inspire_id, self.data.url_json, _snapshot, InspireRecord.snapshot_version)
+
+    def load_record_json(self):
+        self.data.inspire_record_json = self.query(self.data.url_json)
+
+    def link(self, name):
+        if self.data.record_links:
+            return self.data.record_links.get(name)
+        return None
+
+    def load_latex_us(self):
+        self.data.url_latex_us = self.link("latex-us")
+        if self.data.url_latex_us is None:
+            self.data.url_latex_us = url_literature(self.data.inspire_id, "latex-us")
+        self.data.latex_us = self.query(self.data.url_latex_us, parse_json=False)  # .decode("utf-8") # this should be TEXT not json!
+        if isinstance(self.data.latex_us, bytes):
+            self.data.latex_us = self.data.latex_us.decode('utf-8')
+
+    def load_bibtex(self):
+        self.data.url_bibtex = self.link("bibtex")
+        if self.data.url_bibtex is None:
+            self.data.url_bibtex = url_literature(self.data.inspire_id, "bibtex")
+        self.data.bibtex = self.query(self.data.url_bibtex, parse_json=False)  # .decode("utf-8") # this should be TEXT not json!
+        if isinstance(self.data.bibtex, bytes):
+            self.data.bibtex = self.data.bibtex.decode('utf-8')
+
+    def load_refers_to(self):
+        _recid = self.data.inspire_id
+        self.data.refers_to_count = None
+        if not needs_count_refresh(self.cache, _recid, self.update):
+            self.data.refers_to_count = self.cache.read_citation_count(_recid)
+            if self.data.refers_to_count is None and not self.update:
+                # full result page cached by older versions
+                self.data.refers_to = self.cache.read_query(url_refersto(_recid))
+                if self.data.refers_to:
+                    self.data.refers_to_count = json.loads(self.data.refers_to)["hits"]["total"]
+                    self.cache.save_citation_count(_recid, self.data.refers_to_count)
+        if self.data.refers_to_count is not None:
+            return
+        feedr = fetch_url(url_refersto_count(_recid))
+        if feedr is None:
+            if fetch_policy().is_degraded(url_refersto_count(_recid)):
+                self.data.degraded = True
+                self.data.refers_to_count = self.cache.read_citation_count(_recid)
+            return
+        self.data.refers_to = json.loads(feedr)
+        self.data.refers_to_count = self.data.refers_to["hits"]["total"]
+        self.cache.save_citation_count(_recid, self.data.refers_to_count)
 
     def int_or_string(self, s):
         if s.isnumeric():
             return int(s)
         return s
 
+    @staticmethod
+    def in_projection(what):
+        _keys = what.split(".")
+        if _keys[0] != "metadata":
+            return True
+        return len(_keys) < 2 or _keys[1] in gProjectionFields
+
+    # the complete literature json - replaces a projected document if needed
+    def full_json(self):
+        if self.data.projected:
+            self.data.url_json = url_literature(self.data.inspire_id)
+            self.data.inspire_record_json = self.query(self.data.url_json)
+            self.data.projected = False
+        return self.data.inspire_record_json
+
+    # like q() but falls back to the full document for paths outside the projection
+    def q_full(self, what):
+        if self.data.projected and (what == "." or not InspireRecord.in_projection(what)):
+            self.full_json()
+        if what == ".":
+            return self.data.inspire_record_json
+        return self.q(what)
+
     # short for query json
     def q(self, what):
         try:
@@ -467,56 +2020,39 @@ class InspireRecord(GenericObject):
     def query(self, url_inspire, parse_json=True, update=False):
         if self.verbose:
             print("[i] query string", url_inspire)
-        retval = None
-        if self.update or update:
-            try:
-                if self.verbose:
-                    print("[i] fetching data from the web")
-                feedr = urllib.request.urlopen(url_inspire).read()
-                self.read_from_web = True
-            except urllib.error.URLError as e:
-                print(
-                    "[e] unable to read from the web - link tried",
-                    url_inspire,
-                    file=sys.stderr,
-                )
-                print(" . ", e)
+        feedr = None
+        if not needs_refresh(self.cache, url_inspire, self.update or update):
+            feedr = self.cache.read_query(url_inspire=url_inspire)
+            if not feedr and fetch_policy().refuse_offline(url_inspire):
+                self.data.degraded = True
                 return None
-            except http.client.IncompleteRead as e:
-                _part = e.partial
-                print("[e] got incomplete read from", url_inspire, file=sys.stderr)
-                print("    trying one more time...", file=sys.stderr)
-                try:
-                    feedr = urllib.request.urlopen(url_inspire).read()
-                except:
-                    print("   failed. skipping.", file=sys.stderr)
+        if not feedr:
+            # not cached (or purged since it was marked fresh) - fetch it here rather than asking again
+            if not self.update and self.cache.is_negative(url_inspire, fetch_policy().negative_ttl):
+                return None
+            if self.verbose:
+                print("[i] fetching data from the web")
+            feedr = revalidate_url(url_inspire, self.cache)
+            if feedr is None:
+                if not fetch_policy().is_degraded(url_inspire):
                     return None
-            except http.client.RemoteDisconnected as e:
-                print("[e] got disconnected while", url_inspire, file=sys.stderr)
-                print("    trying one more time...", file=sys.stderr)
-                try:
-                    feedr = urllib.request.urlopen(url_inspire).read()
-                except:
-                    print("   failed. skipping.", file=sys.stderr)
+                self.data.degraded = True
+                # a stale copy is better than nothing
+                feedr = self.cache.read_query(url_inspire=url_inspire)
+                if feedr is None:
                     return None
-            self.cache.save_query(url_inspire=url_inspire, feedr=feedr)
-            if parse_json:
-                retval = json.loads(feedr)
+                print("[w] using cached copy of", url_inspire, file=sys.stderr)
             else:
-                retval = feedr
-            return retval
-        else:
-            feedr = self.cache.read_query(url_inspire=url_inspire)
-            if feedr:
-                if parse_json:
-                    retval = json.loads(feedr)
-                else:
-                    retval = feedr
-                return retval
-            else:
-                return self.query(url_inspire, parse_json=parse_json, update=True)
+                self.read_from_web = True
+        if parse_json:
+            return json.loads(feedr)
+        return feedr
 
+    # once per record - input lines listing the same paper share this object (RecordsDB.share_duplicates)
     def protect_latex(self):
+        if self.latex_protected:
+            return
+        self.latex_protected = True
         if self.data.title is None:
             print(self.data)
         self.data.title = self.data.title.replace("{{", "{ {")  # jekyll...
@@ -542,7 +2078,7 @@ class Record(GenericObject):
             "note": self.note,
             "PI": self.PI,
         }
-        with open(filename, "w") as f:
+        with AtomicFile(filename) as f:
             yaml.dump(data, f)
 
     def read_yaml(self, filename):
@@ -550,6 +2086,46 @@ class Record(GenericObject):
             data = yaml.load(f)
         self.init_from_dict(data)
 
+# --- atomic_file.py
+
+# written to a temporary file next to the target and renamed into place on close - readers never see a partial file
+class AtomicFile(object):
+    def __init__(self, filename, mode="w"):
+        self.filename = filename
+        _dir = os.path.dirname(os.path.abspath(filename))
+        _fd, self.tmpname = tempfile.mkstemp(dir=_dir, prefix="." + os.path.basename(filename) + ".")
+        os.chmod(self.tmpname, 0o644)
+        self._f = os.fdopen(_fd, mode)
+
+    def write(self, s):
+        return self._f.write(s)
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        if self._f.closed:
+            return
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self.tmpname, self.filename)
+
+    def discard(self):
+        self._f.close()
+        if os.path.exists(self.tmpname):
+            os.remove(self.tmpname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
 # --- records_db.py
 
 class RecordsDB(GenericObject):
@@ -557,22 +2133,417 @@ class RecordsDB(GenericObject):
     def __init__(self, filename, **kwargs):
         super().__init__(**kwargs)
         self.filename = filename
-        if self.verbose:
+        if self.verbose and filename:
             print("[i] reading from", filename)
         self.records = []
         self.arxiv_list = []
         self.inspire_list = []
-        self.read_yaml(filename)
+        if filename:
+            self.read_yaml(filename)
+        if self.harvest:
+            self.harvest_records(self.harvest)
+        if self.shard:
+            self.select_shard()
         self.process()
 
     def process(self):
         if self.records:
             for p in self.records:
+                if p.source is None:
+                    continue
+                # one spelling per paper, so input variants share aliases, cache entries and the record
                 if p["source"].lower().startswith("arxiv"):
+                    p.id = canonical_arxiv_id(p["id"])
+                if p["source"].lower().startswith("inspire"):
+                    p.id = canonical_recid(p["id"])
+            if self.delta:
+                self.apply_delta_state()
+            for p in self.records:
+                if p.source is None or p.delta:
+                    continue
+                if p["source"].lower().startswith("arxiv") and not p.inspire_id:
                     self.arxiv_list.append("{}".format(p["id"]))
                 if p["source"].lower().startswith("inspire"):
                     self.inspire_list.append("{}".format(p["id"]))
-        self.prescan_with_threading()
+        self.resolve_arxiv_ids()
+        self.fetch_records_bulk()
+        self.fetch_exports_bulk()
+        if self.batch_citations:
+            self.fetch_citation_counts_bulk()
+        if self.engine == "asyncio":
+            self.prescan_with_asyncio()
+        else:
+            self.prescan_with_threading()
+
+    def prescan_with_asyncio(self):
+        engine = AsyncFetchEngine(
+            download=self.download,
+            concurrency=self.concurrency,
+            groups=self.fetch_groups,
+            projection=self.projection,
+            verbose=self.verbose,
+        )
+        _unique = self.unique_records()
+        engine.run([self.records[i] for i in _unique])
+        # everything needed is in the cache now
+        self.inspire_records = [None] * len(self.records)
+        for i in tqdm.tqdm(_unique, desc="reading records"):
+            self.inspire_records[i] = InspireRecord(
+                from_record=self.records[i], update=False, verbose=self.verbose, groups=self.fetch_groups, projection=self.projection
+            )
+        self.share_duplicates()
+
+    # resolve arxiv ids in a few OR-combined eprint searches - misses go through the per-record fallbacks
+    def resolve_arxiv_ids(self):
+        cache = Cache.shared(verbose=self.verbose)
+        _download = self.download
+        _batch_size = self.batch_size or 100
+        resolved = {}
+        _todo = []
+        for _aid in dict.fromkeys(self.arxiv_list):
+            _recid = None
+            if not _download:
+                _recid = cache.read_alias(_aid)
+                if _recid is None and cache.is_negative("arxiv:" + _aid, fetch_policy().negative_ttl):
+                    continue
+            if _recid:
+                resolved[_aid] = _recid
+            else:
+                _todo.append(_aid)
+        _batches = [_todo[i : i + _batch_size] for i in range(0, len(_todo), _batch_size)]
+        for _batch in tqdm.tqdm(_batches, desc="resolving arxiv ids", disable=len(_batches) < 1):
+            _q = " or ".join(["eprint {}".format(_aid) for _aid in _batch])
+            _url = url_search(_q, size=2 * len(_batch), fields="control_number,arxiv_eprints")
+            _wanted = set(_batch)
+            while _url:
+                feedr = fetch_url(_url)
+                if feedr is None:
+                    break
+                _js = json.loads(feedr)
+                for _hit in _js["hits"]["hits"]:
+                    for _e in _hit["metadata"].get("arxiv_eprints", []):
+                        if _e.get("value") in _wanted:
+                            resolved[_e["value"]] = str(_hit["id"])
+                            cache.save_alias(_e["value"], _hit["id"])
+                _url = _js.get("links", {}).get("next")
+        for p in self.records:
+            if p["source"].lower().startswith("arxiv") and p["id"] in resolved:
+                p.inspire_id = resolved[p["id"]]
+        if self.verbose:
+            print("[i] resolved", len(resolved), "of", len(self.arxiv_list), "arxiv ids in", len(_batches), "batches")
+
+    @staticmethod
+    def delta_key(record):
+        return "{}:{}".format(str(record["source"]).lower(), record["id"])
+
+    # --delta: rows of the previous run are kept for records whose updated date and citation counts did not move
+    def apply_delta_state(self):
+        self.delta_state = read_delta_state(self.delta)
+        if self.delta_state.get("format") != self.format or bool(self.delta_state.get("protect_latex")) != bool(self.protect_latex):
+            if self.delta_state:
+                print("[i] delta: output options changed since the state was written - rendering all rows", file=sys.stderr)
+            return
+        cache = Cache.shared(verbose=self.verbose)
+        _entries = self.delta_state.get("records", {})
+        _known = {}
+        for p in self.records:
+            _entry = _entries.get(RecordsDB.delta_key(p))
+            if _entry is not None and _entry.get("recid") and _entry.get("row") is not None:
+                # no need to resolve the arXiv id again
+                p.inspire_id = _entry["recid"]
+                _known.setdefault(_entry["recid"], []).append(p)
+        _recids = list(_known)
+        _batch_size = self.batch_size or 100
+        _batches = [_recids[i : i + _batch_size] for i in range(0, len(_recids), _batch_size)]
+        for _batch in tqdm.tqdm(_batches, desc="checking for changes since the last run", disable=len(_batches) < 1):
+            _q = " or ".join(["recid:{}".format(_recid) for _recid in _batch])
+            _url = url_search(_q, size=len(_batch), fields="control_number,citation_count,citation_count_without_self_citations")
+            while _url:
+                feedr = fetch_url(_url)
+                if feedr is None:
+                    # not confirmed unchanged - these go through the normal path
+                    break
+                _js = json.loads(feedr)
+                for _hit in _js["hits"]["hits"]:
+                    for p in _known.get(str(_hit["id"]), []):
+                        _entry = _entries[RecordsDB.delta_key(p)]
+                        _now = [_hit.get("updated"), _hit["metadata"].get("citation_count"), _hit["metadata"].get("citation_count_without_self_citations")]
+                        if _now == [_entry.get("updated"), _entry.get("citation_count"), _entry.get("citation_count_wsc")]:
+                            p.delta = _entry
+                            continue
+                        # changed on INSPIRE - whatever the cache holds for it predates this,
+                        # unless it was fetched during this run (e.g. by --harvest)
+                        _recid = str(_hit["id"])
+                        for _url_purge in [url_literature(_recid), url_literature_projected(_recid), url_literature(_recid, "bibtex"), url_literature(_recid, "latex-us")]:
+                            if not cache.is_fresh(_url_purge):
+                                cache.purge(_url_purge)
+                        if _now[1] is not None:
+                            cache.save_citation_count(_recid, _now[1])
+                _url = _js.get("links", {}).get("next")
+        # an id listed twice is still one row of the output
+        _keys = set([RecordsDB.delta_key(p) for p in self.records if p.source is not None])
+        _unchanged = set([RecordsDB.delta_key(p) for p in self.records if p.delta])
+        print("[i] delta: {} of {} rows unchanged since the last run".format(len(_unchanged), len(_keys)), file=sys.stderr)
+
+    # --shard i/N: keep the records whose canonical id hashes to shard i (1..N) - the same on every host
+    def select_shard(self):
+        _i, _n = parse_shard(self.shard)
+        _records = []
+        for p in self.records:
+            _id = "{}".format(p["id"])
+            if str(p["source"]).lower().startswith("arxiv"):
+                _id = canonical_arxiv_id(_id)
+            else:
+                _id = canonical_recid(_id)
+            if zlib.crc32(_id.encode("utf-8")) % _n == _i - 1:
+                _records.append(p)
+        if self.verbose:
+            print("[i] shard {}/{}: {} of {} records".format(_i, _n, len(_records), len(self.records)))
+        self.records = _records
+
+    # one key per paper: the recid once known, else the arXiv id
+    @staticmethod
+    def record_key(record):
+        if record["source"].lower().startswith("inspire"):
+            return "{}".format(record["id"])
+        if record.inspire_id:
+            return "{}".format(record.inspire_id)
+        return "arxiv:{}".format(record["id"])
+
+    # indices of the first record of each paper - duplicates are built once and shared (share_duplicates)
+    def unique_records(self):
+        self.first_of = []
+        _seen = {}
+        for i, record in enumerate(self.records):
+            self.first_of.append(_seen.setdefault(RecordsDB.record_key(record), i))
+        _unique = [i for i, _first in enumerate(self.first_of) if _first == i and not self.records[i].delta]
+        if self.verbose and len(_unique) < len(self.records):
+            print("[i]", len(self.records) - len(_unique), "duplicate input records collapsed")
+        return _unique
+
+    def share_duplicates(self):
+        for i, _first in enumerate(self.first_of):
+            if _first != i:
+                self.inspire_records[i] = self.inspire_records[_first]
+                self.records[i].degraded = self.records[_first].degraded
+
+    def recids(self):
+        _recids = []
+        for p in self.records:
+            if p.delta:
+                continue
+            if p["source"].lower().startswith("inspire"):
+                _recids.append("{}".format(p["id"]))
+            elif p.inspire_id:
+                _recids.append("{}".format(p.inspire_id))
+        return list(dict.fromkeys(_recids))
+
+    # pull literature json for many recids per search page and split it into per-record cache entries
+    def fetch_records_bulk(self):
+        cache = Cache.shared(verbose=self.verbose)
+        _download = self.download
+        _todo = []
+        _known = {}
+        for _recid in self.recids():
+            _url = url_literature_json(_recid, self.projection, cache, _download)
+            if not _download and cache.is_negative(_url, fetch_policy().negative_ttl):
+                continue
+            if not cache.has_query(_url):
+                _todo.append(_recid)
+            elif needs_refresh(cache, _url, _download):
+                _known[_recid] = _url
+        if _download:
+            # --download ignores the local copy - everything is fetched again
+            _todo.extend(_known)
+        else:
+            _todo.extend(self.unchanged_records_filter(_known))
+        _batch_size = self.batch_size or 100
+        _batches = [_todo[i : i + _batch_size] for i in range(0, len(_todo), _batch_size)]
+        _n = 0
+        for _batch in tqdm.tqdm(_batches, desc="fetching records", disable=len(_batches) < 1):
+            _q = " or ".join(["recid:{}".format(_recid) for _recid in _batch])
+            if self.projection:
+                _url = url_search(_q, size=len(_batch), fields=",".join(gProjectionFields))
+            else:
+                _url = url_search(_q, size=len(_batch))
+            while _url:
+                feedr = fetch_url(_url)
+                if feedr is None:
+                    break
+                _js = json.loads(feedr)
+                for _hit in _js["hits"]["hits"]:
+                    self.store_hit(cache, _hit)
+                    _n += 1
+                _url = _js.get("links", {}).get("next")
+        if self.verbose:
+            print("[i] fetched", _n, "of", len(_todo), "records in", len(_batches), "batches")
+
+    # one search hit -> the cache entry url_literature_json() looks up, plus its arXiv alias
+    def store_hit(self, cache, hit):
+        _url = url_literature(hit["id"])
+        if self.projection:
+            _url = url_literature_projected(hit["id"])
+        cache.save_query(_url, json.dumps(hit).encode("utf-8"))
+        for _e in hit["metadata"].get("arxiv_eprints", [])[:1]:
+            cache.save_alias(_e["value"], hit["id"])
+
+    # --harvest: page through an INSPIRE search and keep every hit as an already fetched INSPIRE record
+    def harvest_records(self, query):
+        cache = Cache.shared(verbose=self.verbose)
+        _page_size = self.harvest_page_size or 250
+        if self.projection:
+            _url = url_search(query, sort="mostrecent", size=_page_size, fields=",".join(gProjectionFields))
+        else:
+            _url = url_search(query, sort="mostrecent", size=_page_size)
+        pbar = None
+        while _url:
+            feedr = fetch_url(_url)
+            if feedr is None:
+                print("[e] harvest incomplete - could not read", _url, file=sys.stderr)
+                break
+            _js = json.loads(feedr)
+            if pbar is None:
+                _total = _js["hits"]["total"]
+                if _total > 10000:
+                    print("[w] {} hits - INSPIRE pages through at most 10000, split the query (e.g. by date range)".format(_total), file=sys.stderr)
+                pbar = tqdm.tqdm(total=_total, desc="harvesting")
+            for _hit in _js["hits"]["hits"]:
+                self.store_hit(cache, _hit)
+                self.records.append(Record(id="{}".format(_hit["id"]), source="inspire"))
+                pbar.update(1)
+            _url = _js.get("links", {}).get("next")
+        if pbar is not None:
+            pbar.close()
+
+    # what the bulk stages read from a cached record - taken from its snapshot, the (multi-MB) json is parsed only without one
+    @staticmethod
+    def cached_record_fields(cache, recid, url_inspire):
+        _snapshot = cache.read_snapshot(recid, url_inspire, InspireRecord.snapshot_version)
+        if _snapshot is not None:
+            return _snapshot
+        feedr = cache.read_query(url_inspire)
+        if feedr is None:
+            return None
+        _js = json.loads(feedr)
+        return {
+            "updated_date": _js.get("updated"),
+            "citation_count": _js["metadata"].get("citation_count"),
+            "citation_count_wsc": _js["metadata"].get("citation_count_without_self_citations"),
+            "record_links": _js.get("links"),
+            "texkeys": _js["metadata"].get("texkeys"),
+        }
+
+    # ask for updated + citation counts only and keep the cached records that match - returns the recids to refetch
+    def unchanged_records_filter(self, known):
+        if len(known) < 1:
+            return []
+        cache = Cache.shared(verbose=self.verbose)
+        _fields = ["updated", "citation_count", "citation_count_without_self_citations"]
+        _cached = {}
+        for _recid, _url in known.items():
+            _record = RecordsDB.cached_record_fields(cache, _recid, _url)
+            _cached[_recid] = [_record["updated_date"], _record["citation_count"], _record["citation_count_wsc"]]
+        _changed = set(known)
+        _recids = list(known)
+        _batch_size = self.batch_size or 100
+        _batches = [_recids[i : i + _batch_size] for i in range(0, len(_recids), _batch_size)]
+        for _batch in tqdm.tqdm(_batches, desc="checking for updates", disable=len(_batches) < 1):
+            _q = " or ".join(["recid:{}".format(_recid) for _recid in _batch])
+            _url = url_search(_q, size=len(_batch), fields="control_number," + ",".join(_fields[1:]))
+            while _url:
+                feedr = fetch_url(_url)
+                if feedr is None:
+                    break
+                _js = json.loads(feedr)
+                for _hit in _js["hits"]["hits"]:
+                    _recid = str(_hit["id"])
+                    _now = [_hit.get("updated")] + [_hit["metadata"].get(_f) for _f in _fields[1:]]
+                    if _recid in _cached and _now == _cached[_recid]:
+                        # the exports are generated from the same record
+                        for _url_touch in [known[_recid], url_literature(_recid, "bibtex"), url_literature(_recid, "latex-us")]:
+                            cache.touch(_url_touch)
+                        _changed.discard(_recid)
+                _url = _js.get("links", {}).get("next")
+        if self.verbose:
+            print("[i]", len(known) - len(_changed), "of", len(known), "cached records unchanged")
+        return [_recid for _recid in _recids if _recid in _changed]
+
+    # citation counts for many recids per request, from metadata.citation_count of a projected search
+    def fetch_citation_counts_bulk(self):
+        if self.fetch_groups is not None and "refers_to" not in self.fetch_groups:
+            return
+        cache = Cache.shared(verbose=self.verbose)
+        _todo = []
+        for _recid in self.recids():
+            if cache.is_fresh_count(_recid):
+                continue
+            if needs_count_refresh(cache, _recid, self.download) or cache.read_citation_count(_recid) is None:
+                _todo.append(_recid)
+        _batch_size = self.batch_size or 100
+        _batches = [_todo[i : i + _batch_size] for i in range(0, len(_todo), _batch_size)]
+        for _batch in tqdm.tqdm(_batches, desc="fetching citation counts", disable=len(_batches) < 1):
+            _q = " or ".join(["recid:{}".format(_recid) for _recid in _batch])
+            _url = url_search(_q, size=len(_batch), fields="control_number,citation_count")
+            while _url:
+                feedr = fetch_url(_url)
+                if feedr is None:
+                    break
+                _js = json.loads(feedr)
+                for _hit in _js["hits"]["hits"]:
+                    _count = _hit["metadata"].get("citation_count")
+                    if _count is not None:
+                        cache.save_citation_count(_hit["id"], _count)
+                _url = _js.get("links", {}).get("next")
+
+    # pull bibtex / latex-us for many recids per search response and split it per entry (matched by texkey)
+    def fetch_exports_bulk(self):
+        cache = Cache.shared(verbose=self.verbose)
+        _entry_start = {
+            "bibtex": re.compile(r"^@\w+\{([^,\s]+),", re.MULTILINE),
+            "latex-us": re.compile(r"^%\\cite\{([^}]+)\}", re.MULTILINE),
+        }
+        for _fmt, _regex in _entry_start.items():
+            if self.fetch_groups is not None and _fmt.replace("-", "_") not in self.fetch_groups:
+                continue
+            _todo = {}
+            for _recid in self.recids():
+                _url = url_literature(_recid, _fmt)
+                if cache.has_query(_url) and not needs_refresh(cache, _url, self.download):
+                    continue
+                _record = RecordsDB.cached_record_fields(cache, _recid, url_literature_json(_recid, self.projection, cache))
+                if _record is None:
+                    continue
+                _url = (_record["record_links"] or {}).get(_fmt)
+                if _url is None:
+                    _url = url_literature(_recid, _fmt)
+                if cache.is_fresh(_url):
+                    continue
+                if needs_refresh(cache, _url, self.download) or not cache.has_query(_url):
+                    for _texkey in (_record["texkeys"] or [])[:1]:
+                        _todo[_texkey] = (_recid, _url)
+            _recids = list(dict.fromkeys([v[0] for v in _todo.values()]))
+            _batch_size = self.batch_size or 100
+            _batches = [_recids[i : i + _batch_size] for i in range(0, len(_recids), _batch_size)]
+            _n = 0
+            for _batch in tqdm.tqdm(_batches, desc=f"fetching {_fmt}", disable=len(_batches) < 1):
+                _q = " or ".join(["recid:{}".format(_recid) for _recid in _batch])
+                _url = url_search(_q, size=len(_batch), format=_fmt)
+                feedr = fetch_url(_url)
+                if feedr is None:
+                    continue
+                _text = feedr.decode("utf-8")
+                _starts = list(_regex.finditer(_text))
+                for i, m in enumerate(_starts):
+                    if m.group(1) not in _todo:
+                        continue
+                    _end = len(_text)
+                    if i < len(_starts) - 1:
+                        _end = _starts[i + 1].start()
+                    _entry = _text[m.start() : _end].rstrip() + "\n"
+                    cache.save_query(_todo[m.group(1)][1], _entry.encode("utf-8"))
+                    _n += 1
+            if self.verbose:
+                print("[i] split", _n, "of", len(_todo), f"{_fmt} entries from", len(_batches), "batches")
 
     def read_yaml(self, filename):
         _tmp_records = GenericObject(init_yaml=filename)
@@ -581,52 +2552,91 @@ class RecordsDB(GenericObject):
                 self.records.append(Record(init_dict=_r))
 
     @staticmethod
-    def get_record_thread(record, args):
-        _ = InspireRecord(from_record=record, update=args.download, verbose=args.debug)
-
-    @staticmethod
-    def count_threads_alive(threads):
-        _count = len([thr for thr in threads if thr.is_alive()])
-        return _count
+    def get_record_thread(record, args, results, i, slots, pbar):
+        try:
+            results[i] = InspireRecord(from_record=record, update=args.download, verbose=args.debug, groups=args.fetch_groups, projection=args.projection)
+        finally:
+            slots.release()
+            pbar.update(1)
 
+    # builds every record once - self.inspire_records follows the input order (None if never scheduled)
     def prescan_with_threading(self):
+        self.inspire_records = [None] * len(self.records)
+        _unique = self.unique_records()
         threads = list()
-        pbar = tqdm.tqdm(self.records, desc="prescanning records (downloading if needed or requested)")
-        for record in self.records:
+        slots = threading.BoundedSemaphore(multiprocessing.cpu_count() * 2)
+        pbar = tqdm.tqdm(total=len(_unique), desc="prescanning records (downloading if needed or requested)")
+        for i in _unique:
+            record = self.records[i]
+            slots.acquire()
+            if fetch_policy().expired():
+                slots.release()
+                break
             x = threading.Thread(
                 target=RecordsDB.get_record_thread,
                 args=(
                     record,
                     self.args,
+                    self.inspire_records,
+                    i,
+                    slots,
+                    pbar,
                 ),
             )
             threads.append(x)
             x.start()
-            pbar.update(1)
-            while RecordsDB.count_threads_alive(threads) >= multiprocessing.cpu_count() * 2:
-                _ = [thr.join(0.1) for thr in threads if thr.is_alive()]
+        for x in threads:
+            x.join()
         pbar.close()
+        self.share_duplicates()
 
 # --- utils.py
 
+gArXivIdNew = re.compile(r"^(\d{4}\.\d{4,5})(v\d+)?$")
+gArXivIdOld = re.compile(r"^([a-z\-]+)(\.[a-z\-]+)?/(\d{7})(v\d+)?$", re.IGNORECASE)
+
+
+# 2301.10001 for arXiv:2301.10001v2, https://arxiv.org/abs/2301.10001 ...; hep-ex/0101001 for hep-ex/0101001v1, HEP-EX/0101001
+def canonical_arxiv_id(aid):
+    if aid is None:
+        return None
+    _aid = str(aid).strip()
+    _aid = re.sub(r"^(https?://)?(www\.|export\.)?arxiv\.org/(abs|pdf)/", "", _aid, flags=re.IGNORECASE)
+    _aid = re.sub(r"\.pdf$", "", _aid)
+    _aid = re.sub(r"^arxiv:", "", _aid, flags=re.IGNORECASE)
+    m = gArXivIdNew.match(_aid)
+    if m:
+        return m.group(1)
+    m = gArXivIdOld.match(_aid)
+    if m:
+        # INSPIRE lists old-style ids without the subject class (math/0601001, not math.AG/0601001)
+        return "{}/{}".format(m.group(1).lower(), m.group(3))
+    return _aid
+
+
+# 1234 for https://inspirehep.net/literature/1234, https://inspirehep.net/api/literature/1234 ...
+def canonical_recid(recid):
+    if recid is None:
+        return None
+    return str(recid).strip().rstrip("/").split("/")[-1].split("?")[0]
+
+
 def starting_record_from_string(sid):
     _r = Record()
-    if 'arxiv' in sid or 'inspire' in sid:
-        if 'arxiv' in sid:
-            _r.id = sid.split('/')[-1]
-            if '.' not in _r.id:
-                _r.id = sid.replace('https://arxiv.org/abs/', '')
+    if 'arxiv' in sid.lower() or 'inspire' in sid.lower():
+        if 'arxiv' in sid.lower():
+            _r.id = canonical_arxiv_id(sid)
             _r.source = 'arxiv'
-        elif 'inspire' in sid:
-            _r.id = sid.split('/')[-1]
+        elif 'inspire' in sid.lower():
+            _r.id = canonical_recid(sid)
             _r.source = 'inspire'
     else:
         if '/' in sid:
-            _r.id = sid.replace('https://arxiv.org/abs/', '')
+            _r.id = canonical_arxiv_id(sid)
             _r.source = 'arxiv'
         else:
             if '.' in sid:
-                _r.id = sid
+                _r.id = canonical_arxiv_id(sid)
                 _r.source = 'arxiv'
             else:
                 _r.id = sid
@@ -677,6 +2687,19 @@ def prescan_with_threading(records, args):
     pbar.close()
 
 
+# which InspireRecord.lazy_groups the output needs - None: all of them
+def fetch_groups(sformat, query_json=None, debug_json=False):
+    if not sformat and not query_json and not debug_json:
+        return None
+    _groups = set()
+    for m in re.finditer(r"{\.[a-zA-Z0-9_]+}*", sformat or ""):
+        _tag = m.group(0).split(".")[1].strip("}")
+        for _group, _fields in InspireRecord.lazy_groups.items():
+            if _tag in _fields:
+                _groups.add(_group)
+    return _groups
+
+
 def formatted_output(sformat, rd):
     regex = r"{\.[a-zA-Z0-9_]+}*"
     matches = re.finditer(regex, sformat, re.MULTILINE)
@@ -730,6 +2753,61 @@ def str_to_record_dict(s):
     return d
 
 
+# stand-in for an InspireRecord whose output row is reused from the --delta state
+class DeltaRecord(GenericObject):
+    def __init__(self, entry, **kwargs):
+        super().__init__(**kwargs)
+        self.entry = entry
+        self.is_valid = True
+        self.data = GenericObject(
+            inspire_id=entry.get("recid"),
+            arxiv_id=entry.get("arxiv_id"),
+            preprint_date=entry.get("preprint_date"),
+            delta_row=entry.get("row"),
+        )
+
+
+def read_delta_state(filename):
+    if not filename or not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+# state for the next --delta run: the row of every record and what it was rendered from
+def write_delta_state(filename, sformat, protect_latex, keyed_records):
+    _records = {}
+    for _key, record in keyed_records.items():
+        if isinstance(record, DeltaRecord):
+            _records[_key] = record.entry
+            continue
+        _records[_key] = {
+            "recid": "{}".format(record.data.inspire_id),
+            "arxiv_id": record.data.arxiv_id,
+            "updated": record.data.updated_date,
+            "citation_count": record.data.citation_count,
+            "citation_count_wsc": record.data.citation_count_wsc,
+            "preprint_date": record.data.preprint_date,
+            "row": formatted_output(sformat, record.data),
+        }
+    with AtomicFile(filename) as f:
+        json.dump({"format": sformat, "protect_latex": protect_latex, "records": _records}, f, indent=1)
+
+
+# records of an input list without writing the .yaml next to it
+def read_input_records(filename):
+    if filename.endswith('.yaml'):
+        _tmp_records = GenericObject(init_yaml=filename)
+        return [Record(init_dict=_r) for _r in (_tmp_records.records or [])]
+    _records = []
+    with open(filename, "r") as f:
+        for line in f.readlines():
+            line = line.split(' ')[0].strip()
+            if len(line) > 0:
+                _records.append(starting_record_from_string(line))
+    return _records
+
+
 def rewrite_text_to_yaml(filename, assume_id='arxiv_id'):
     _d = dict()
     _d['records'] = []
@@ -742,19 +2820,98 @@ def rewrite_text_to_yaml(filename, assume_id='arxiv_id'):
         _rtmp = starting_record_from_string(line.strip())
         _d['records'].append(_rtmp.basic_dict())
     foutputname = filename + ".yaml"
-    with open(foutputname, "w") as f:
+    with AtomicFile(foutputname) as f:
         yaml.dump(_d, f)
     return foutputname
 
+# --- cache_cli.py
+
+def cache_main(argv):
+    parser = argparse.ArgumentParser(description='inspect and maintain the local INSPIRE cache', prog=os.path.basename(__file__) + ' cache')
+    parser.add_argument('--cache-dir', help='cache directory', type=str, default=None)
+    parser.add_argument('-g', '--debug', help='print some extra info', action='store_true', default=False)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help='entries, sizes and age of the cache')
+    parser_gc = subparsers.add_parser('gc', help='evict old / least recently used entries, drop orphaned snapshots and migrated legacy files')
+    parser_gc.add_argument('--max-size', help='keep at most this much blob data (e.g. 500M, 2G)', type=str, default=None)
+    parser_gc.add_argument('--max-age', help='evict entries fetched longer ago than this (e.g. 90d, 12h)', type=str, default=None)
+    parser_gc.add_argument('-n', '--dry-run', help='only report what would be removed', action='store_true', default=False)
+    parser_export = subparsers.add_parser('export', help='pack the cache (or the entries for an input list) into one compressed sqlite bundle')
+    parser_export.add_argument('bundle', help='bundle file to write')
+    parser_export.add_argument('-f', '--file', help='only the records of this input list (.txt or .yaml as for the main command)', type=str, default=None)
+    parser_export.add_argument('--codec', help='blob compression in the bundle', choices=sorted(gCacheCodecs), default='lzma')
+    parser_import = subparsers.add_parser('import', help='merge a bundle into the cache - the more recently fetched copy of an entry wins')
+    parser_import.add_argument('bundle', help='bundle file to read')
+    parser_merge = subparsers.add_parser('merge', help='combine other caches (e.g. --shard runs) into this one - the most recently fetched copy of a url wins')
+    parser_merge.add_argument('sources', help='cache directories or cache / bundle files', nargs='+')
+    parser_negative = subparsers.add_parser('negative', help='known failures (unresolvable arXiv ids, urls that gave errors) skipped until --negative-ttl expires')
+    parser_negative.add_argument('action', choices=['list', 'clear'])
+    parser_negative.add_argument('keys', help='entries to clear (arxiv:<id> or url) - all if none given', nargs='*')
+    args = parser.parse_args(argv)
+
+    cache = Cache.shared(dir=args.cache_dir, verbose=args.debug)
+    if args.command == 'stats':
+        _stats = cache.stats()
+        for _k in ["oldest", "newest"]:
+            if _stats[_k] is not None:
+                _stats[_k] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(_stats[_k]))
+        for _k, _v in _stats.items():
+            print("{:>16}: {}".format(_k, _v))
+    if args.command == 'gc':
+        _result = cache.gc(max_size=parse_size(args.max_size), max_age=parse_age(args.max_age), dry_run=args.dry_run)
+        if args.dry_run:
+            print("[i] dry run - nothing removed")
+        for _k, _v in _result.items():
+            print("{:>20}: {}".format(_k, _v))
+    if args.command == 'export':
+        _recids = None
+        if args.file:
+            _recids = []
+            for _r in read_input_records(args.file):
+                if str(_r.source).lower().startswith('inspire'):
+                    _recids.append(canonical_recid(_r.id))
+                elif cache.read_alias(_r.id):
+                    _recids.append(cache.read_alias(_r.id))
+                else:
+                    print("[w] {} is not resolved in the cache - not exported".format(_r.id), file=sys.stderr)
+        _n = cache.export_bundle(args.bundle, recids=_recids, codec=args.codec)
+        print("[i] exported", _n, "entries to", args.bundle, "({} bytes)".format(os.path.getsize(args.bundle)))
+    if args.command == 'import':
+        _result = cache.import_bundle(args.bundle)
+        for _k, _v in _result.items():
+            print("{:>12}: {}".format(_k, _v))
+    if args.command == 'merge':
+        for _source in args.sources:
+            _file = _source
+            if os.path.isdir(_source):
+                _file = os.path.join(_source, "cache.sqlite")
+            if os.path.abspath(_file) == os.path.abspath(cache.cache_file):
+                print("[w] skipping", _source, "- that is the target cache", file=sys.stderr)
+                continue
+            _result = cache.import_bundle(_file)
+            print("[i] merged", _source, " ".join(["{}={}".format(_k, _v) for _k, _v in _result.items()]))
+    if args.command == 'negative':
+        if args.action == 'list':
+            for _key, _reason, _created in cache.list_negatives():
+                print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(_created)), _key, "-", _reason)
+        if args.action == 'clear':
+            print("[i] cleared", cache.clear_negatives(args.keys), "negative cache entries")
+
+
 # --- main.py
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'cache':
+        return cache_main(sys.argv[2:])
     parser = argparse.ArgumentParser(description='test getting informaion from inspire', prog=os.path.basename(__file__))
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--absid', help="arXiv absid", type=str)
     group.add_argument("--iid", help="INSPIRE id", type=str)
     group.add_argument("-f", "--file", help="file with arXiv absids", type=str)
+    group.add_argument("--harvest", help='INSPIRE search query whose hits are the input, e.g. "collaboration:ALICE and de > 2023-01-01"', type=str)
     parser.add_argument('-d', '--download', help="ignore local copy if exists", action='store_true')
+    parser.add_argument('--negative-ttl', help='how long ids / urls that were not found are skipped without a request (e.g. 1d, 12h; 0 disables) - --download retries them', type=str, default='1d')
+    parser.add_argument('--refresh-older-than', help='refetch cached entries older than this (e.g. 7d, 12h, 30m; a plain number means days) - unchanged entries are revalidated, not downloaded', type=str, default=None)
     parser.add_argument('-l', '--latex', help='print latex strings', action='store_true', default=False)
     parser.add_argument('-m', '--md', help='print md strings', action='store_true', default=True)
     parser.add_argument('-g', '--debug', help='print some extra info', action='store_true', default=False)
@@ -763,47 +2920,118 @@ def main():
     parser.add_argument('-x', '--query-json', help='print stuff from json', type=str, default='')
     parser.add_argument('--format', help='specify format for output using .property to InspireRecordData - example csv: {.absid},{.id},{.preprint_date},{.pub_date},\"{.title}\"', type=str, default='')
     parser.add_argument('-o', '--output', help='output file for formatter output', type=str, default='')
+    parser.add_argument('--pool-size', help='max persistent connections per host shared by all fetching threads', type=int, default=multiprocessing.cpu_count() * 2)
+    parser.add_argument('--rate', help='max INSPIRE requests per second shared by all fetchers (0: no limit); halved on 429/5xx and recovered gradually', type=float, default=3.0)
+    parser.add_argument('--burst', help='requests allowed back-to-back before --rate applies', type=int, default=15)
+    parser.add_argument('--connect-timeout', help='seconds to wait for a connection to INSPIRE', type=float, default=10.0)
+    parser.add_argument('--read-timeout', help='seconds to wait for data on an open connection', type=float, default=60.0)
+    parser.add_argument('--retries', help='retries per request on timeouts, disconnects, 429 and 5xx (exponential backoff with jitter)', type=int, default=3)
+    parser.add_argument('--deadline', help='overall time budget in seconds - after that records are served from cache and reported as degraded', type=float, default=None)
+    parser.add_argument('--engine', help='prescan fetch engine: one thread per record or a single asyncio event loop (no http(s)_proxy support)', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--concurrency', help='max requests in flight for --engine asyncio', type=int, default=100)
+    parser.add_argument('--delta', help='state file of the previous run (written after this one): rows of records whose INSPIRE updated date and citation counts did not change are reused, only new or changed records are fetched and rendered (needs --format)', type=str, default=None)
+    parser.add_argument('--harvest-page-size', help='hits per page for --harvest', type=int, default=250)
+    parser.add_argument('--batch-size', help='number of ids per batched INSPIRE search', type=int, default=100)
+    parser.add_argument('--batch-citations', help='take refers_to_count for many records per request from metadata.citation_count instead of one count-only refersto search per record', action='store_true', default=False)
+    parser.add_argument('--projection', help='download only the literature json fields the output uses (no author lists); -x / --debug-json fall back to the full record', action='store_true', default=False)
+    parser.add_argument('--cache-codec', help='compression for new cache entries (default: zlib) - existing entries stay readable whatever they were written with', choices=sorted(gCacheCodecs), default=None)
+    parser.add_argument('--cache-dir', help='cache directory (default: .cache, or .cache-shard<i>of<N> with --shard)', type=str, default=None)
+    parser.add_argument('--shard', help='with -f: process only part i of N of the input (1 <= i <= N, split by a hash of the id, the same on every host) - combine the caches with "cache merge"', type=str, default=None)
+    parser.add_argument('--offline', help='never contact INSPIRE - serve from the cache (and --bundle) only; missing records are reported as degraded', action='store_true', default=False)
+    parser.add_argument('--bundle', help='read-only cache bundle (inspireq.py cache export) consulted for entries missing from the cache', type=str, default=None)
+    parser.add_argument('--cache-journal', help='sqlite journal mode of the cache (default: delete, safe on NFS and other shared storage); wal lets readers and a writer work concurrently but needs a local filesystem, auto uses wal only where the cache dir is on one', choices=['delete', 'wal', 'auto'], default=None)
+    parser.add_argument('--cache-max-size', help='after the run evict least recently used cache entries until the blobs fit (e.g. 500M, 2G) - the file is compacted by `cache gc`', type=str, default=None)
     parser.add_argument('--protect-latex', help='modify latex text - protection for jekyll for example', action='store_true', default=False)
 
     args = parser.parse_args()
 
     global gDebug
     gDebug = args.debug
+    global gCacheCodec
+    if args.cache_codec:
+        gCacheCodec = args.cache_codec
+    global gCacheBundle
+    gCacheBundle = args.bundle
+    global gCacheDir
+    gCacheDir = args.cache_dir
+    if args.shard:
+        if args.harvest:
+            # every shard would page through and cache the whole search result to keep 1/N of it
+            parser.error('--shard cannot split a --harvest search - run the harvest once, or split the query itself (e.g. by date range) across jobs')
+        if not args.file:
+            parser.error('--shard works on an input list (-f)')
+        try:
+            _i, _n = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        if gCacheDir is None:
+            gCacheDir = os.curdir + "/.cache-shard{}of{}".format(_i, _n)
+    global gCacheJournal
+    if args.cache_journal:
+        gCacheJournal = args.cache_journal
     if gDebug:
         print('[i] debug mode on')
 
+    if args.engine == "asyncio" and proxy_for(urllib.parse.urlsplit(gInspireURL).scheme, urllib.parse.urlsplit(gInspireURL).hostname):
+        # the asyncio client opens its sockets directly - only the thread pool goes through http(s)_proxy
+        parser.error('--engine asyncio cannot go through the configured http(s)_proxy - use --engine threads')
+    global gHTTPPool
+    gHTTPPool = HTTPConnectionPool(pool_size=args.pool_size)
+    global gRateLimiter
+    gRateLimiter = RateLimiter(rate=args.rate, burst=args.burst)
+    global gFetchPolicy
+    gFetchPolicy = FetchPolicy(connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, retries=args.retries, deadline=args.deadline,
+                               refresh_older_than=parse_age(args.refresh_older_than), negative_ttl=parse_age(args.negative_ttl), offline=args.offline)
+    Cache.new_run()
+
+    # only the endpoints the output refers to are requested up front
+    args.fetch_groups = fetch_groups(args.format, args.query_json, args.debug_json)
+    if args.delta and not args.format:
+        parser.error('--delta reuses --format rows - give --format')
+    if args.delta and not (args.file or args.harvest):
+        parser.error('--delta works on an input list (-f or --harvest)')
+
     records = []
     if args.absid:
         # record = InspireRecord(from_string = f'{args.absid}', update=args.download, verbose=args.debug)
         _r = starting_record_from_string(args.absid)
-        record = InspireRecord(from_record = _r, update=args.download, verbose=args.debug)
+        record = InspireRecord(from_record = _r, update=args.download, verbose=args.debug, groups=args.fetch_groups, projection=args.projection)
         records.append(record)
 
     if args.iid:
         # _r = Record(id=f"{args.iid}", source="INSPIRE", note="test", PI="test")
         _r = starting_record_from_string(args.iid)
-        record = InspireRecord(from_record = _r, update=args.download, verbose=args.debug)
+        record = InspireRecord(from_record = _r, update=args.download, verbose=args.debug, groups=args.fetch_groups, projection=args.projection)
         records.append(record)
 
     ids_all = []
     ids_duplicates = []
+    ids_degraded = []
+    delta_records = {}
     db = None
-    if args.file:
+    if args.file or args.harvest:
         # if file extension is .txt, convert to .yaml
         # if args.file.endswith('.txt'):
-        if not args.file.endswith('.yaml'):
+        if args.file and not args.file.endswith('.yaml'):
             args.file = rewrite_text_to_yaml(args.file)
         db = RecordsDB(args.file, args=args, verbose=args.debug)
-        for _r in tqdm.tqdm(db.records, desc='reading records'):
-            # don't update - done in multithreaded prescan...
-            record = InspireRecord(from_record = _r, update=False, verbose=args.debug)
+        for _r, record in zip(db.records, db.inspire_records):
+            if _r.delta:
+                record = DeltaRecord(_r.delta)
+            if record is None:
+                # not built in the prescan (deadline) - whatever the cache has
+                record = InspireRecord(from_record = _r, update=False, verbose=args.debug, groups=args.fetch_groups, projection=args.projection)
+            if record.data.degraded or _r.degraded:
+                ids_degraded.append(_r["id"])
             if record.is_valid is False:
                 continue
+            if args.delta:
+                delta_records[RecordsDB.delta_key(_r)] = record
             if record.data.inspire_not_found is True:
                 print('warning] no entry for: {_r}.", file=sys.stderr')
                 pass
             else:
-                if args.protect_latex:
+                if args.protect_latex and not isinstance(record, DeltaRecord):
                     record.protect_latex()
                 aid = record.data.arxiv_id
                 if aid == 'n/a':
@@ -819,32 +3047,34 @@ def main():
     # for record in sorted_with_inspire_date(records=records):
     fout = sys.stdout
     if args.output:
-        fout = open(args.output, 'w')
+        fout = AtomicFile(args.output)
     for record in sorted_with_preprint_date(records=records):
         if record is None:
             continue
         if args.format:
-            _s = formatted_output(args.format, record.data)
+            _s = record.data.delta_row
+            if _s is None:
+                _s = formatted_output(args.format, record.data)
             if header == 0:
                 header = 1
                 print(args.format.replace(".", "").replace("{", "").replace("}", ""), file=fout)
             print(_s, file=fout)
             continue
         if args.debug_json:
-            print(json.dumps(record.record_json, indent=2))
+            print(json.dumps(record.full_json(), indent=2))
             continue
         if args.query_json:
             _squery = args.query_json
             _subquery = None
             do_iter = args.debug_json_iter
             if args.query_json == ".":
-                _x = record.record_json
+                _x = record.q_full(".")
             else:
                 if '@' in args.query_json:
                     _squery = args.query_json.split('@')[0]
                     _subquery = args.query_json.split('@')[1]
                     do_iter = True
-                _x = record.q(_squery)
+                _x = record.q_full(_squery)
             if do_iter:
                 print("[x]", args.query_json)
                 if type(_x) is str:
@@ -863,7 +3093,7 @@ def main():
                     "[x]",
                     args.query_json,
                     "=",
-                    json.dumps(record.q(args.query_json), indent=2),
+                    json.dumps(record.q_full(args.query_json), indent=2),
                 )
             continue
         # print(record.data)
@@ -874,6 +3104,23 @@ def main():
         for aid in ids_duplicates:
             print(f"[warning] absid: {aid} duplicated in the input.", file=sys.stderr)
 
+    if len(ids_degraded) > 0:
+        print(f"[warning] {len(ids_degraded)} record(s) degraded (deadline or fetch errors - cached data used where available):", " ".join(ids_degraded), file=sys.stderr)
+
+    if args.delta:
+        write_delta_state(args.delta, args.format, args.protect_latex, delta_records)
+
+    if args.cache_max_size:
+        # no VACUUM after a report run - concurrent jobs would wait on it; `cache gc` compacts the file
+        Cache.shared(verbose=args.debug).gc(max_size=parse_size(args.cache_max_size), vacuum=False)
+
+    if gHTTPPool.n_requests > 0:
+        print("[i] http:", gHTTPPool.stats(), file=sys.stderr)
+    if single_flight().n_shared > 0:
+        print("[i] {} fetches shared an in-flight request".format(single_flight().n_shared), file=sys.stderr)
+    if gRateLimiter.n_throttled > 0:
+        print("[i] rate limiter:", gRateLimiter.stats(), file=sys.stderr)
+
 
 if __name__=="__main__":
     main()
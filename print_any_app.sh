@@ -39,7 +39,7 @@ if [ "x${is_download_flag_set}" == "xyes" ]; then
 	download_flag="--download"
 fi
 
-./execvenv.sh python ./inspireq.py -f ${input_file} --format "{.arxiv_id},{.inspire_id},{.preprint_date},{.pub_date},\"{.title}\",\"{.journal_info}\",{.url_record},{.doi}" --output ${foutput} ${download_flag}
+./execvenv.sh python ./inspireq.py -f ${input_file} --format "{.arxiv_id},{.inspire_id},{.preprint_date},{.pub_date},\"{.title}\",\"{.journal_info}\",{.url_record},{.doi}" --output ${foutput} --projection ${download_flag}
 if [ $? -ne 0 ]; then
 	echo_error "Error querying INSPIRE"
 	exit 1
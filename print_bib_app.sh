@@ -44,7 +44,7 @@ if [ "x${is_download_flag_set}" == "xyes" ]; then
 	download_flag="--download"
 fi
 
-./execvenv.sh python ./inspireq.py -f ${input_file} --format "{.bibtex}" --output ${bib_file} ${download_flag}
+./execvenv.sh python ./inspireq.py -f ${input_file} --format "{.bibtex}" --output ${bib_file} --projection ${download_flag}
 if [ $? -ne 0 ]; then
 	echo_error "Error querying INSPIRE"
 	exit 1
@@ -39,7 +39,7 @@ if [ "x${is_download_flag_set}" == "xyes" ]; then
 	download_flag="--download"
 fi
 
-./execvenv.sh ./inspireq.py -f ${input_file} --format "{.arxiv_id},{.inspire_id},{.preprint_date},{.pub_date},\"{.title}\",\"{.journal_info}\",{.url_record},{.doi}" --output ${foutput} ${download_flag}
+./execvenv.sh ./inspireq.py -f ${input_file} --format "{.arxiv_id},{.inspire_id},{.preprint_date},{.pub_date},\"{.title}\",\"{.journal_info}\",{.url_record},{.doi}" --output ${foutput} --projection ${download_flag}
 
 this_year=$(date '+%Y')
 
@@ -0,0 +1,74 @@
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import inspireq  # noqa: E402
+
+N_PROCESSES = 8
+N_OPENS = 10
+
+
+# several report jobs starting at once on one cache directory
+def open_cache_repeatedly(cache_dir, errors):
+    for _ in range(N_OPENS):
+        try:
+            cache = inspireq.Cache(dir=cache_dir)
+            cache.save_query("https://example.org/{}".format(os.getpid()), b"{}")
+            cache._db.close()
+        except Exception as e:
+            errors.put("{}: {}".format(type(e).__name__, e))
+
+
+class TestCacheConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def open_in_parallel(self):
+        _ctx = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+        _errors = _ctx.Queue()
+        _workers = [_ctx.Process(target=open_cache_repeatedly, args=(self.cache_dir, _errors)) for _ in range(N_PROCESSES)]
+        for _worker in _workers:
+            _worker.start()
+        for _worker in _workers:
+            _worker.join(120)
+            self.assertEqual(_worker.exitcode, 0)
+        _messages = []
+        while not _errors.empty():
+            _messages.append(_errors.get())
+        self.assertEqual(_messages, [])
+
+    def columns(self, table):
+        _db = sqlite3.connect(os.path.join(self.cache_dir, "cache.sqlite"))
+        try:
+            return [_row[1] for _row in _db.execute("PRAGMA table_info({})".format(table))]
+        finally:
+            _db.close()
+
+    def test_fresh_cache_dir(self):
+        self.open_in_parallel()
+        self.assertIn("accessed", self.columns("queries"))
+        self.assertIn("version", self.columns("snapshots"))
+
+    def test_cache_with_an_old_schema(self):
+        os.makedirs(self.cache_dir)
+        _db = sqlite3.connect(os.path.join(self.cache_dir, "cache.sqlite"))
+        _db.execute("CREATE TABLE queries (url TEXT PRIMARY KEY, data BLOB, fetched REAL)")
+        _db.execute("CREATE TABLE snapshots (recid TEXT PRIMARY KEY, url TEXT, blob_hash TEXT, data TEXT)")
+        _db.execute("INSERT INTO queries (url, data, fetched) VALUES ('https://example.org/old', X'7B7D', 0)")
+        _db.commit()
+        _db.close()
+        self.open_in_parallel()
+        self.assertIn("codec", self.columns("queries"))
+        self.assertIn("version", self.columns("snapshots"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import inspireq  # noqa: E402
+
+
+# just enough of the INSPIRE literature API for inspire-id input
+class FakeInspire(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    records = {}
+    requests = []
+    # full-document searches miss these, as while the INSPIRE search index lags behind a change
+    unindexed = set()
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body, ctype="application/json"):
+        body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        FakeInspire.requests.append(self.path)
+        _url = urllib.parse.urlparse(self.path)
+        _qs = dict(urllib.parse.parse_qsl(_url.query))
+        m = re.match(r"/api/literature/(\d+)$", _url.path)
+        if m:
+            if m.group(1) not in self.records:
+                return self.send(404, "{}")
+            if _qs.get("format", "json") != "json":
+                return self.send(200, "@article{{x{},}}\n".format(m.group(1)), "text/plain")
+            return self.send(200, json.dumps(self.records[m.group(1)]))
+        if _url.path == "/api/literature":
+            _hits = []
+            if _qs.get("q") == "collaboration:TEST":
+                _hits = list(self.records.values())
+            for _recid in re.findall(r"recid:(\d+)", _qs.get("q", "")):
+                if _recid in self.records and ("fields" in _qs or _recid not in self.unindexed):
+                    _hits.append(self.records[_recid])
+            return self.send(200, json.dumps({"hits": {"total": len(_hits), "hits": _hits}, "links": {}}))
+        self.send(404, "{}")
+
+
+def make_record(recid, title, updated):
+    return {
+        "id": str(recid),
+        "created": "2023-01-02T00:00:00+00:00",
+        "updated": updated,
+        "links": {},
+        "metadata": {
+            "control_number": recid,
+            "titles": [{"title": title}],
+            "preprint_date": "2023-01-15",
+            "citation_count": 3,
+            "citation_count_without_self_citations": 1,
+        },
+    }
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        FakeInspire.records = {
+            "1001": make_record(1001, "First title", "2024-01-01T00:00:00+00:00"),
+            "1002": make_record(1002, "Second title", "2024-01-01T00:00:00+00:00"),
+        }
+        FakeInspire.requests = []
+        FakeInspire.unindexed = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeInspire)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = inspireq.gInspireURL
+        inspireq.gInspireURL = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.tmp.name, "in.txt")
+        with open(self.input, "w") as f:
+            f.write("1001\n1002\n1001\n")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        inspireq.gInspireURL = self.url
+        self.tmp.cleanup()
+
+    def run_main(self, *args):
+        _argv = sys.argv
+        sys.argv = [
+            "inspireq.py",
+            *(args or ["-f", self.input]),
+            "--format", "{.inspire_id},{.title}",
+            "--delta", os.path.join(self.tmp.name, "state.json"),
+            "--cache-dir", os.path.join(self.tmp.name, "cache"),
+        ]
+        _out = io.StringIO()
+        _err = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(_out), contextlib.redirect_stderr(_err):
+                inspireq.main()
+        finally:
+            sys.argv = _argv
+        return _out.getvalue(), _err.getvalue()
+
+    def test_changed_record_is_queried_again_in_the_same_process(self):
+        _out, _ = self.run_main()
+        self.assertIn("1002,Second title", _out)
+        # the first run left 1002 fresh in the shared cache of this process
+        FakeInspire.records["1002"] = make_record(1002, "Changed title", "2025-05-05T00:00:00+00:00")
+        # the bulk stage finds nothing, so the record itself has to be queried again
+        FakeInspire.unindexed = set(["1002"])
+        FakeInspire.requests = []
+        _out, _err = self.run_main()
+        self.assertIn("1002,Changed title", _out)
+        self.assertIn("1001,First title", _out)
+        self.assertIn("[i] delta: 1 of 2 rows unchanged", _err)
+        self.assertIn("/api/literature/1002?format=json", FakeInspire.requests)
+        # the change check, then 1002 alone
+        self.assertIn("1001", FakeInspire.requests[0])
+        for _path in FakeInspire.requests[1:]:
+            self.assertNotIn("1001", _path)
+
+    def test_harvested_record_is_not_downloaded_again(self):
+        self.run_main("--harvest", "collaboration:TEST")
+        FakeInspire.records["1002"] = make_record(1002, "Changed title", "2025-05-05T00:00:00+00:00")
+        FakeInspire.requests = []
+        _out, _err = self.run_main("--harvest", "collaboration:TEST")
+        self.assertIn("1002,Changed title", _out)
+        self.assertIn("[i] delta: 1 of 2 rows unchanged", _err)
+        # the harvest page, then the change check - the harvest already holds the changed 1002
+        self.assertEqual(len(FakeInspire.requests), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()